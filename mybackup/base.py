@@ -7,7 +7,7 @@
 # ]
 
 import sys, os, fcntl, time, threading, weakref, re, types, copy
-import codecs, traceback, hashlib
+import codecs, traceback, hashlib, selectors, stat, collections
 from functools import partial
 
 
@@ -27,44 +27,280 @@ class FLockError (Exception) :
     pass
 
 
+# FLockStats:
+#
+# Counters maintained by every FLock. 'ncontended' is the number of
+# times the lock could not be taken at once (because another thread
+# or another process held it) and 'wait_time' the total time spent
+# waiting for it then.
+#
+class FLockStats :
+
+
+    avg_wait = property(lambda s: (s.wait_time / s.ncontended) if s.ncontended else 0.0)
+
+
+    # __init__:
+    #
+    def __init__ (self) :
+        self.nlocks = 0
+        self.ncontended = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+
+    # __str__:
+    #
+    def __str__ (self) :
+        return ('%d locks, %d contended, wait %.3fs (avg %.3fs, max %.3fs)' %
+                (self.nlocks, self.ncontended, self.wait_time,
+                 self.avg_wait, self.max_wait))
+
+
 # FLock:
 #
+# An exclusive flock() on 'fname', as a context manager. If 'block'
+# is False, entering raises FLockError at once if the lock is taken,
+# otherwise it blocks in flock() until the lock is released, or
+# raises FLockError after 'timeout' seconds if not 0 (the blocking
+# call is then made by a waiter thread).
+#
+# By default the lock file is opened when the lock is taken and
+# closed when it is released. After open() the same fd is kept until
+# close(), which saves the open() of each locking.
+#
+# The lock is reentrant and may be shared by the threads of the
+# process, which are serialized by a mutex before the flock().
+#
 class FLock :
 
-    def __init__ (self, fname, block=True, timeout=0, delay=0.1) :
-        # i guess that one FLock instance should never be used from
-        # different threads, so let's check for that
-        self.thread = weakref.ref(threading.current_thread())
+
+    # __init__:
+    #
+    def __init__ (self, fname, block=True, timeout=0) :
         self.fname = fname
         self.block = block
         self.timeout = timeout
-        self.delay = delay
-        self.fd = 0
+        self.fd = -1
+        self.keep = False
+        self.depth = 0
+        self.mutex = threading.RLock()
+        self.stats = FLockStats()
+
+
+    # open:
+    #
+    def open (self) :
+        with self.mutex :
+            self.keep = True
+            if self.fd < 0 :
+                self.fd = os.open(self.fname, os.O_WRONLY | os.O_CREAT, 0o644)
+
+
+    # close:
+    #
+    # If the lock is held, the fd is closed when it is released.
+    #
+    def close (self) :
+        with self.mutex :
+            self.keep = False
+            if self.fd >= 0 and self.depth == 0 :
+                os.close(self.fd)
+                self.fd = -1
+
 
     def __enter__ (self) :
-        if threading.current_thread() is not self.thread() :
-            assert 0, "FLock instances can't be shared by different threads!"
-        self.fd = os.open(self.fname, os.O_WRONLY | os.O_CREAT)
-        start = time.time()
-        while True :
-            try:
-                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            except BlockingIOError:
-                if self.timeout > 0 and (time.time() - start) >= self.timeout :
-                    raise FLockError("could not lock '%s' after %d seconds" %
-                                     (self.fname, self.timeout))
-                time.sleep(self.delay)
-                continue
-            break
+        self.acquire()
+        return self
 
     def __exit__ (self, tp, exc, tb) :
-        if self.fd != 0 :
-            os.close(self.fd)
+        self.release()
+        return False
+
+
+    # acquire:
+    #
+    def acquire (self) :
+        start = time.monotonic()
+        contended = False
+        if not self.mutex.acquire(blocking=False) :
+            contended = True
+            if not self.block :
+                raise FLockError("could not lock '%s'" % self.fname)
+            if not self.mutex.acquire(timeout=(self.timeout if self.timeout > 0 else -1)) :
+                raise FLockError("could not lock '%s' after %g seconds" %
+                                 (self.fname, self.timeout))
+        try:
+            if self.depth == 0 :
+                if self.fd < 0 :
+                    self.fd = os.open(self.fname, os.O_WRONLY | os.O_CREAT, 0o644)
+                try:
+                    contended = self.__flock(start) or contended
+                except:
+                    if not self.keep :
+                        os.close(self.fd)
+                        self.fd = -1
+                    raise
+            self.depth += 1
+        except:
+            self.mutex.release()
+            raise
+        if self.depth == 1 :
+            stats = self.stats
+            stats.nlocks += 1
+            if contended :
+                wait = time.monotonic() - start
+                stats.ncontended += 1
+                stats.wait_time += wait
+                stats.max_wait = max(stats.max_wait, wait)
+
+
+    # release:
+    #
+    def release (self) :
+        assert self.depth > 0
+        self.depth -= 1
+        if self.depth == 0 :
+            if self.keep :
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            else :
+                # closing the fd releases the lock
+                os.close(self.fd)
+                self.fd = -1
+        self.mutex.release()
+
+
+    # __flock:
+    #
+    # Returns True if the lock had to be waited for.
+    #
+    def __flock (self, start) :
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not self.block :
+                raise FLockError("could not lock '%s'" % self.fname)
+            if self.timeout > 0 :
+                self.__flock_wait(start)
+            else :
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            return True
         return False
 
 
+    # __flock_wait:
+    #
+    # Blocking flock() with a timeout. The waiter thread locks its own
+    # open file (not a dup of ours, which would share the lock), which
+    # then replaces ours. If we give up first, it closes it as soon as
+    # it gets the lock.
+    #
+    def __flock_wait (self, start) :
+        fd = os.open(self.fname, os.O_WRONLY | os.O_CREAT, 0o644)
+        cond = threading.Condition()
+        state = {'done': False, 'abandoned': False, 'error': None}
+        def waiter () :
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except OSError as exc:
+                state['error'] = exc
+            with cond :
+                state['done'] = True
+                if state['abandoned'] or state['error'] is not None :
+                    os.close(fd)
+                cond.notify_all()
+        threading.Thread(target=waiter, daemon=True,
+                         name='flock:%s' % self.fname).start()
+        with cond :
+            cond.wait_for(lambda: state['done'],
+                          max(0.0, self.timeout - (time.monotonic() - start)))
+            if not state['done'] :
+                state['abandoned'] = True
+                raise FLockError("could not lock '%s' after %g seconds" %
+                                 (self.fname, self.timeout))
+        if state['error'] is not None :
+            raise state['error']
+        os.close(self.fd)
+        self.fd = fd
+
+
+# BufferPool:
+#
+# A fixed set of 'count' reusable buffers of 'size' bytes. get()
+# blocks until a buffer is available.
+#
+class BufferPool :
+
+
+    # __init__:
+    #
+    def __init__ (self, size=65536, count=1) :
+        assert size > 0 and count > 0, (size, count)
+        self.size = size
+        self.count = count
+        self.cond = threading.Condition()
+        self.free = [memoryview(bytearray(size)) for n in range(count)]
+
+
+    # get:
+    #
+    def get (self) :
+        with self.cond :
+            while not self.free :
+                self.cond.wait()
+            return self.free.pop()
+
+
+    # put:
+    #
+    def put (self, buf) :
+        with self.cond :
+            self.free.append(buf)
+            self.cond.notify()
+
+
+# PipeStats:
+#
+# Counters maintained by every PipeThread. Times are in seconds,
+# 'read_time' is spent waiting for the source and 'write_time'
+# feeding the outputs.
+#
+class PipeStats :
+
+
+    avg_chunk = property(lambda s: (s.nbytes // s.nreads) if s.nreads else 0)
+
+
+    # __init__:
+    #
+    def __init__ (self) :
+        self.nbytes = 0
+        self.nreads = 0
+        self.read_time = 0.0
+        self.write_time = 0.0
+
+
+    # __str__:
+    #
+    def __str__ (self) :
+        return ('%s in %d reads (avg %s), read %.3fs, write %.3fs' %
+                (human_size(self.nbytes), self.nreads,
+                 human_size(self.avg_chunk), self.read_time,
+                 self.write_time))
+
+
 # PipeThread:
 #
+# Copy everything from 'fin' to all the 'fout' files, optionally
+# hashing the data and passing it line by line to a
+# 'line_handler'. By default each pipe runs its own thread ; if a
+# PipeLoop is given, the pipe is driven by the loop's thread instead.
+#
+# Data is read in chunks of 'bufsize' bytes. If 'nbufs' is not 0, the
+# chunks are read with readinto() in a pool of 'nbufs' preallocated
+# buffers instead of new bytes objects, in which case the outputs
+# must not keep a reference on the data they are given.
+#
 class PipeThread :
 
 
@@ -73,7 +309,8 @@ class PipeThread :
     
     # __init__:
     #
-    def __init__ (self, name, fin, fout, started=False, line_handler=None, hashtype='') :
+    def __init__ (self, name, fin, fout, started=False, line_handler=None, hashtype='', loop=None,
+                  bufsize=65536, nbufs=0) :
         self.name = name
         self.fin = fin
         self.fout = list(fout)
@@ -87,9 +324,19 @@ class PipeThread :
             self.decoder = codec(errors='replace')
         self.hashtype = ''
         self.start_lock = threading.Lock() # just in case ?
-        self.thread = threading.Thread(target=self.run)
+        self.loop = loop
+        if loop is None :
+            self.thread = threading.Thread(target=self.run)
+        else :
+            self.thread = None
+            self.done = threading.Event()
         self.alive = True
         self.started = False
+        self.error = None
+        self.data_size = 0
+        self.stats = PipeStats()
+        self.bufsize = bufsize
+        self.bufpool = BufferPool(bufsize, nbufs) if nbufs > 0 else None
         self.set_hashtype(hashtype)
         if started : self.start()
 
@@ -118,54 +365,115 @@ class PipeThread :
         with self.start_lock :
             assert not self.started
             self.started = True
-            self.thread.start()
+            if self.loop is None :
+                self.thread.start()
+            else :
+                self.loop.add(self)
 
 
     # join:
     #
+    # Raises the error which stopped the pipe's loop, if any.
+    #
     def join (self) :
         with self.start_lock :
             assert self.started
             assert self.alive
             #trace("%s: join" % self.name)
-            self.thread.join()
+            if self.loop is None :
+                self.thread.join()
+            else :
+                self.done.wait()
             #trace("%s: dead" % self.name)
             self.started = False
             self.alive = False
+            if self.error is not None :
+                raise self.error
             
 
     # run:
     #
+    # The error which stops the pipe is raised by join().
+    #
     def run (self) :
         try:
             self._run()
-        except Exception:
-            # [fixme] error("%s: exception:" % self.name)
-            print_exception()
-            sys.exit(1)
+        except Exception as exc:
+            self.error = exc
 
     def _run (self) :
         #trace("%s: start" % self.name)
+        self._begin(self.fout)
+        if self.bufpool is not None :
+            self._run_pool()
+            return
+        stats = self.stats
+        while True :
+            t0 = time.perf_counter()
+            data = self.fin.read(self.bufsize)
+            stats.read_time += time.perf_counter() - t0
+            if not data : break
+            self._feed(data)
+        self._finish()
+
+
+    # _run_pool:
+    #
+    def _run_pool (self) :
+        stats = self.stats
+        while True :
+            buf = self.bufpool.get()
+            try:
+                t0 = time.perf_counter()
+                n = self.fin.readinto(buf)
+                stats.read_time += time.perf_counter() - t0
+                if not n : break
+                self._feed(buf[:n])
+            finally:
+                self.bufpool.put(buf)
+        self._finish()
+
+
+    # _begin:
+    #
+    # Called once before the first _feed(), with the list of file
+    # objects the data must be written to.
+    #
+    def _begin (self, outputs) :
+        self.outputs = outputs
         self.data_size = 0
         if self.line_handler is not None :
             self.line_buffer = ''
-        while True :
-            data = self.fin.read(65536)
-            if not data : break
-            self.data_size += len(data)
-            for f in self.fout :
-                f.write(data)
-            if self.hashtype :
-                self.hasher.update(data)
-            if self.line_handler is not None :
-                ldata = self.decoder.decode(data, False)
-                self._process_lines(ldata, False)
-        # flush the line handler
+
+
+    # _feed:
+    #
+    def _feed (self, data) :
+        size = len(data)
+        self.data_size += size
+        self.stats.nbytes += size
+        self.stats.nreads += 1
+        t0 = time.perf_counter()
+        for f in self.outputs :
+            f.write(data)
+        self.stats.write_time += time.perf_counter() - t0
+        if self.hashtype :
+            self.hasher.update(data)
+        if self.line_handler is not None :
+            ldata = self.decoder.decode(data, False)
+            self._process_lines(ldata, False)
+
+
+    # _finish:
+    #
+    # Called on EOF: flush the line handler and close the outputs.
+    #
+    def _finish (self) :
         if self.line_handler is not None :
             ldata = self.decoder.decode(b'', True)
             self._process_lines(ldata, True)
         #trace("%s: EOF" % self.name)
-        for f in self.fout :
+        for f in self.outputs :
             f.close()
 
 
@@ -184,6 +492,354 @@ class PipeThread :
             self.line_buffer = ''
 
 
+# PipeLoop:
+#
+# Drive any number of PipeThread instances from a single thread with
+# a selector. Sources are read without blocking ; outputs which are
+# pipes are written without blocking too (with a bounded amount of
+# pending data, above which their source is paused), everything else
+# (regular files, compressors, ...) is written directly from the
+# loop. The thread is started when the first pipe is added and
+# exits when no pipe is left, so a loop can be reused and shared.
+#
+class PipeLoop :
+
+
+    # max bytes waiting in a pipe output before its source is paused
+    MAX_PENDING = 1 << 20
+
+
+    # __init__:
+    #
+    def __init__ (self, name) :
+        self.name = name
+        self.lock = threading.Lock()
+        self.incoming = []
+        self.channels = set()
+        self.thread = None
+        self.selector = None
+        self.wakeup = None
+        # CPU time used by the loop's thread so far
+        self.cpu_time = 0.0
+
+
+    # add:
+    #
+    # Start driving 'pipe' (called by PipeThread.start()).
+    #
+    def add (self, pipe) :
+        with self.lock :
+            self.incoming.append(pipe)
+            if self.thread is None :
+                self.selector = selectors.DefaultSelector()
+                self.wakeup = os.pipe()
+                for fd in self.wakeup :
+                    os.set_blocking(fd, False)
+                self.selector.register(self.wakeup[0], selectors.EVENT_READ,
+                                       self.__on_wakeup)
+                self.thread = threading.Thread(target=self.run,
+                                               name='pipeloop:%s' % self.name)
+                self.thread.start()
+            else :
+                try:
+                    os.write(self.wakeup[1], b'\0')
+                except BlockingIOError:
+                    pass # already woken up
+
+
+    # run:
+    #
+    # If the loop itself fails, the pipes still in it are aborted and
+    # their join() raises the error.
+    #
+    def run (self) :
+        try:
+            self._run()
+        except BaseException as exc:
+            self.__abort_all(exc)
+
+    def _run (self) :
+        cpu0 = time.thread_time() - self.cpu_time
+        while True :
+            self.cpu_time = time.thread_time() - cpu0
+            with self.lock :
+                for pipe in self.incoming :
+                    self.channels.add(_LoopChannel(self, pipe))
+                self.incoming = []
+                if not self.channels :
+                    self.__shutdown()
+                    return
+            for key, events in self.selector.select() :
+                key.data(events)
+
+
+    # __abort_all:
+    #
+    def __abort_all (self, exc) :
+        with self.lock :
+            chans = list(self.channels)
+            pipes = [c.pipe for c in chans] + self.incoming
+            self.incoming = []
+            for pipe in pipes :
+                pipe.error = exc
+            for chan in chans :
+                try:
+                    chan.abort()
+                except Exception:
+                    pass # the selector may be what failed
+            self.channels.clear()
+            for pipe in pipes :
+                pipe.done.set()
+            self.__shutdown()
+
+
+    # __shutdown:
+    #
+    # Called with the lock held when the last channel is gone.
+    #
+    def __shutdown (self) :
+        self.selector.close()
+        for fd in self.wakeup :
+            os.close(fd)
+        self.selector = None
+        self.wakeup = None
+        self.thread = None
+
+
+    # __on_wakeup:
+    #
+    def __on_wakeup (self, events) :
+        try:
+            os.read(self.wakeup[0], 4096)
+        except BlockingIOError:
+            pass
+
+
+    # _remove:
+    #
+    def _remove (self, chan) :
+        self.channels.discard(chan)
+
+
+# _LoopChannel:
+#
+# The state of one PipeThread inside a PipeLoop.
+#
+class _LoopChannel :
+
+
+    # __init__:
+    #
+    def __init__ (self, loop, pipe) :
+        self.loop = loop
+        self.pipe = pipe
+        self.fd = pipe.fin.fileno()
+        os.set_blocking(self.fd, False)
+        self.sinks = []
+        outputs = []
+        for f in pipe.fout :
+            if _is_pipe(f) :
+                sink = _LoopSink(self, f)
+                self.sinks.append(sink)
+                outputs.append(sink)
+            else :
+                outputs.append(f)
+        self.eof = False
+        self.reading = True
+        pipe._begin(outputs)
+        loop.selector.register(self.fd, selectors.EVENT_READ, self.on_read)
+
+
+    # on_read:
+    #
+    def on_read (self, events) :
+        pool = self.pipe.bufpool
+        buf = None
+        try:
+            t0 = time.perf_counter()
+            try:
+                if pool is None :
+                    data = os.read(self.fd, self.pipe.bufsize)
+                else :
+                    buf = pool.get()
+                    data = buf[:os.readv(self.fd, (buf,))]
+            except BlockingIOError:
+                return
+            finally:
+                self.pipe.stats.read_time += time.perf_counter() - t0
+            if data :
+                self.pipe._feed(data)
+            else :
+                self.eof = True
+                self.__pause()
+                self.pipe._finish()
+            self.update()
+        except Exception as exc:
+            # a failed output or line handler: join() raises
+            self.pipe.error = exc
+            self.abort()
+        finally:
+            if buf is not None :
+                pool.put(buf)
+
+
+    # update:
+    #
+    # Pause or resume the source depending on the outputs state, and
+    # check if we are done.
+    #
+    def update (self) :
+        if self.eof :
+            if all(s.closed for s in self.sinks) :
+                self.__done()
+        elif any(s.npending > self.loop.MAX_PENDING for s in self.sinks) :
+            self.__pause()
+        elif not self.reading :
+            self.loop.selector.register(self.fd, selectors.EVENT_READ,
+                                        self.on_read)
+            self.reading = True
+
+
+    # abort:
+    #
+    # Something went wrong, close everything.
+    #
+    def abort (self) :
+        self.__pause()
+        for s in self.sinks :
+            s.abort()
+        self.eof = True
+        self.__done()
+
+
+    # __pause:
+    #
+    def __pause (self) :
+        if self.reading :
+            self.loop.selector.unregister(self.fd)
+            self.reading = False
+
+
+    # __done:
+    #
+    def __done (self) :
+        self.loop._remove(self)
+        self.pipe.done.set()
+
+
+# _LoopSink:
+#
+# A pipe output of a _LoopChannel.
+#
+class _LoopSink :
+
+
+    # __init__:
+    #
+    def __init__ (self, chan, f) :
+        self.chan = chan
+        self.f = f
+        self.fd = f.fileno()
+        os.set_blocking(self.fd, False)
+        self.pending = collections.deque()
+        self.npending = 0
+        self.writing = False
+        self.closing = False
+        self.closed = False
+
+
+    # write:
+    #
+    def write (self, data) :
+        data = memoryview(data)
+        if not self.pending :
+            try:
+                n = os.write(self.fd, data)
+            except BlockingIOError:
+                n = 0
+            data = data[n:]
+            if not data :
+                return
+        # keep a private copy, the caller may reuse its buffer
+        self.pending.append(bytes(data))
+        self.npending += len(data)
+        self.__flush()
+
+
+    # close:
+    #
+    def close (self) :
+        self.closing = True
+        self.__flush()
+
+
+    # abort:
+    #
+    def abort (self) :
+        self.pending.clear()
+        self.npending = 0
+        self.closing = True
+        self.__close()
+
+
+    # on_write:
+    #
+    def on_write (self, events) :
+        try:
+            self.__flush()
+            self.chan.update()
+        except Exception as exc:
+            self.chan.pipe.error = exc
+            self.chan.abort()
+
+
+    # __flush:
+    #
+    def __flush (self) :
+        try:
+            while self.pending :
+                data = self.pending[0]
+                n = os.write(self.fd, data)
+                self.npending -= n
+                if n < len(data) :
+                    self.pending[0] = data[n:]
+                else :
+                    self.pending.popleft()
+        except BlockingIOError:
+            pass
+        selector = self.chan.loop.selector
+        if self.pending and not self.writing :
+            selector.register(self.fd, selectors.EVENT_WRITE, self.on_write)
+            self.writing = True
+        elif self.writing and not self.pending :
+            selector.unregister(self.fd)
+            self.writing = False
+        if self.closing and not self.pending :
+            self.__close()
+
+
+    # __close:
+    #
+    def __close (self) :
+        if self.closed :
+            return
+        if self.writing :
+            self.chan.loop.selector.unregister(self.fd)
+            self.writing = False
+        self.f.close()
+        self.closed = True
+
+
+# _is_pipe:
+#
+def _is_pipe (f) :
+    try:
+        fd = f.fileno()
+    except (AttributeError, OSError):
+        return False
+    return stat.S_ISFIFO(os.fstat(fd).st_mode)
+
+
 # format_exception:
 #
 def format_exception (exc_info=None) :
@@ -399,6 +1055,55 @@ def _atd_deepcopy (s, m) :
     return s.__class__(**kw)
 
 
+# slotrecord:
+#
+# Create a record class with the same API as attrdict, but whose
+# fields are stored in __slots__: no per instance dict, no copy of
+# the defaults and plain attribute lookups. 'fields' is a sequence of
+# names or (name, default) pairs ; the fields without a default must
+# be given to the constructor. Defaults are shared by all the
+# instances, so they must not be mutated. Subclasses must set
+# '__slots__ = ()' to keep the benefit.
+#
+def slotrecord (tpname, fields) :
+    names, params, defaults = [], [], {}
+    for f in fields :
+        if isinstance(f, str) :
+            names.append(f)
+            params.append(f)
+        else :
+            n, v = f
+            names.append(n)
+            defaults['_d_' + n] = v
+            params.append('%s=_d_%s' % (n, n))
+    src = ['def __init__ (self, *, %s) :' % ', '.join(params)]
+    src.extend('    self.%s = %s' % (n, n) for n in names)
+    if not names :
+        src.append('    pass')
+    ns = dict(defaults)
+    exec('\n'.join(src), ns)
+    tpdict = {
+        '__slots__': tuple(names),
+        '_fields': tuple(names),
+        '__init__': ns['__init__'],
+        '__repr__': _slr_repr,
+        '__getitem__': _slr_getitem,
+        'asdict': _slr_asdict,
+        'update': _atd_update,
+    }
+    return type(tpname, (object,), tpdict)
+
+def _slr_asdict (s) :
+    return dict((n, getattr(s, n)) for n in s._fields)
+
+def _slr_repr (s) :
+    return '<%s %s>' % (s.__class__.__name__, s.asdict())
+
+def _slr_getitem (s, n) :
+    assert n[0] != '_' # ?
+    return getattr(s, n)
+
+
 # enum:
 #
 class enumbase :
@@ -467,16 +1172,23 @@ _DumpState = enum(
      'selected', 'scheduled', 'started', 'empty',
     'aborted'))
 
+# (sqlite gives the raw bytes of a column to its converter)
+_DUMPSTATE_BYTES = dict((n.encode(), n) for n in _DumpState.byname)
+
 class DumpState (_DumpState) :
 
     @staticmethod
     def adapt (*args) :
         assert 0, args
 
+    # convert:
+    #
+    # The DB stores the lower case names, only the unexpected values
+    # go through tostr().
+    #
     @staticmethod
     def convert (value) :
-        # [fixme] is it normal to get bytes objects from sq3 ?
-        return DumpState.tostr(value.decode())
+        return _DUMPSTATE_BYTES.get(value) or DumpState.tostr(value.decode())
 
 
 # Plural forms handling
@@ -487,6 +1199,7 @@ _plurals = {
     'error': 'errors',
     'warning': 'warnings',
     'strange line': 'strange lines',
+    'note': 'notes',
 }
 
 def plural_register (single, plural) :
@@ -511,121 +1224,214 @@ def plural (n, single, plural=None, addn=True) :
 
 
 
-_JRunInfo = attrdict('_JRunInfo')
-_JDumpInfo = attrdict('_JDumpInfo')
+# SampleList:
+#
+# A list which only keeps the first 'limit' items appended to it (all
+# of them if 0). 'total' counts all the items. An item can stand for
+# several others (a summary of skipped lines): 'weight' sums the
+# counts given to append(), dropped items included.
+#
+class SampleList (list) :
+
+
+    skipped = property(lambda s: s.total - len(s))
+
+
+    # __init__:
+    #
+    def __init__ (self, limit=0) :
+        list.__init__(self)
+        self.limit = limit
+        self.total = 0
+        self.weight = 0
+
+
+    # append:
+    #
+    def append (self, item, count=1) :
+        self.total += 1
+        self.weight += count
+        if self.limit <= 0 or len(self) < self.limit :
+            list.append(self, item)
+
+
+    # merge:
+    #
+    # Append the samples of 'other' and count its skipped items.
+    #
+    def merge (self, other) :
+        weight = self.weight + other.weight
+        for item in other :
+            self.append(item)
+        self.total += other.skipped
+        self.weight = weight
+
+
+_JRunInfo = slotrecord('_JRunInfo', ('config', 'start_hrs', 'end_hrs', 'runid', 'dumps',
+                                      'errors', 'warnings', 'stranges',
+                                      'strange_summaries', 'notes', 'messages'))
+
+_JDumpInfo = slotrecord('_JDumpInfo', ('disk',
+                                       ('state', 'selected'),
+                                       ('fname', ''),
+                                       ('prevrun', -1),
+                                       ('raw_size', -1),
+                                       ('comp_size', -1),
+                                       ('nfiles', -1),
+                                       ('hashtype', 'sha1'), # [FIXME]
+                                       ('hashsum', ''),
+                                       ('nfixes', 0)))
 
 class JRunInfo (_JRunInfo) :
 
-    def __init__ (self) :
+    __slots__ = ()
+
+    MESSAGE_LISTS = ('errors', 'warnings', 'stranges',
+                     'strange_summaries', 'notes', 'messages')
+
+    def __init__ (self, samples=0) :
         _JRunInfo.__init__(self,
                            config='X',
                            start_hrs='X',
                            end_hrs='X',
                            runid=0,
                            dumps={},
-                           errors=[],
-                           warnings=[],
-                           stranges=[],
-                           notes=[],
-                           messages=[])
+                           **dict((n, SampleList(samples))
+                                  for n in JRunInfo.MESSAGE_LISTS))
 
 class JDumpInfo (_JDumpInfo) :
 
-    def __init__ (self, disk) :
-        _JDumpInfo.__init__(self,
-                            disk=disk,
-                            state='selected',
-                            fname='',
-                            prevrun=-1,
-                            raw_size=-1,
-                            comp_size=-1,
-                            nfiles=-1,
-                            hashtype='sha1', # [FIXME]
-                            hashsum='',
-                            nfixes=0)
-    
+    __slots__ = ()
 
-# JState:
+
+# JRunFolder:
 #
-class JState :
+# Streaming analysis of a run's journal: the entries are given one at
+# a time to feed(), in the order they were recorded, and folded into
+# a JRunInfo returned by finish(). Only the first 'samples' messages
+# of each kind are kept (all of them if 0), the others are counted.
+#
+# Only the sessions of 'tools' are analysed. The clean sessions are
+# folded apart, and only the last one is merged into the result.
+#
+class JRunFolder :
 
 
-    # analysis:
+    # __init__:
     #
-    @staticmethod
-    def analysis (state) :
-        runinfo = JRunInfo()
-        for session in state :
-            op = session[0]
-            assert op.key == '_OPEN', op
-            if op.tool == 'dump' :
-                JState._analysis_dump(runinfo, session)
-            elif op.tool == 'clean' :
-                JState._analysis_clean(runinfo, session)
-            else :
-                assert 0, op
-        return runinfo
+    def __init__ (self, samples=0, tools=('dump', 'clean')) :
+        self.samples = samples
+        self.tools = tools
+        self.runinfo = JRunInfo(samples)
+        self.ndumps = 0
+        # the last clean session: (JRunInfo, [(disk, state)])
+        self.clean = None
+        self.handler = None
 
-    @staticmethod
-    def _analysis_dump (runinfo, ss) :
-        for ent in ss[1:] :
-            if JState._analysis_message(runinfo, ent) :
-                continue
-            elif ent.key == 'START' :
-                assert runinfo.start_hrs == 'X'
-                runinfo.update(config=ent.config, start_hrs=ent.hrs, runid=ent.runid)
-            elif ent.key == 'SELECT' :
-                runinfo.dumps = dict((n, JDumpInfo(disk=n))
-                                     for n in ent.disks.split(','))
-            elif ent.key == 'SCHEDULE' :
-                assert runinfo.dumps[ent.disk].state == 'selected'
-                runinfo.dumps[ent.disk].update(state='scheduled', prevrun=ent.prevrun)
-            elif ent.key == 'DUMP-START' :
-                assert runinfo.dumps[ent.disk].state == 'scheduled'
-                runinfo.dumps[ent.disk].update(state='partial', fname=ent.fname)
-            elif ent.key == 'DUMP-FINISHED' :
-                assert runinfo.dumps[ent.disk].state == 'partial'
-                runinfo.dumps[ent.disk].update(state=DumpState.tostr(ent.state),
-                                               raw_size=ent.raw_size,
-                                               comp_size=ent.comp_size,
-                                               nfiles=ent.nfiles,
-                                               hashtype=ent.hashtype,
-                                               hashsum=ent.hashsum)
-            elif ent.key == 'DUMP-ABORT' :
-                runinfo.dumps[ent.disk].update(state=DumpState.ABORTED)
-            elif ent.key == 'USER-MESSAGE' :
-                runinfo.messages.append((ent.level, ent.message))
-            elif ent.key == 'END' :
-                assert runinfo.end_hrs == 'X'
-                runinfo.update(end_hrs=ent.hrs)
+
+    # feed:
+    #
+    def feed (self, ent) :
+        if ent.key == '_OPEN' :
+            assert ent.tool in ('dump', 'clean'), ent
+            if ent.tool not in self.tools :
+                self.handler = None
+            elif ent.tool == 'dump' :
+                assert self.ndumps == 0, ent
+                self.ndumps += 1
+                self.handler = self.__feed_dump
             else :
-                assert 0, ent
+                self.clean = (JRunInfo(self.samples), [])
+                self.handler = self.__feed_clean
+        elif ent.key == '_CLOSE' :
+            self.handler = None
+        elif self.handler is not None :
+            self.handler(ent)
 
 
-    # _analysis_clean:
+    # finish:
     #
-    @staticmethod
-    def _analysis_clean (runinfo, ss) :
-        for ent in ss[1:] :
-            if JState._analysis_message(runinfo, ent) :
-                continue
-            elif ent.key == 'DUMP-FIX' :
-                dump = runinfo.dumps[ent.disk]
-                if not DumpState.cmp(ent.state, 'none') :
-                    dump.state = ent.state
+    def finish (self) :
+        runinfo = self.runinfo
+        if self.clean is not None :
+            cleaninfo, fixes = self.clean
+            for n in JRunInfo.MESSAGE_LISTS :
+                getattr(runinfo, n).merge(getattr(cleaninfo, n))
+            for disk, state in fixes :
+                dump = runinfo.dumps[disk]
+                if not DumpState.cmp(state, 'none') :
+                    dump.state = state
                 dump.nfixes += 1
-            else :
-                assert 0, ent
+            self.clean = None
+        return runinfo
+
+
+    # __feed_dump:
+    #
+    def __feed_dump (self, ent) :
+        runinfo = self.runinfo
+        if self.__feed_message(runinfo, ent) :
+            pass
+        elif ent.key == 'START' :
+            assert runinfo.start_hrs == 'X'
+            runinfo.update(config=ent.config, start_hrs=ent.hrs, runid=ent.runid)
+        elif ent.key == 'SELECT' :
+            runinfo.dumps = dict((n, JDumpInfo(disk=n))
+                                 for n in ent.disks.split(','))
+        elif ent.key == 'SCHEDULE' :
+            assert runinfo.dumps[ent.disk].state == 'selected'
+            runinfo.dumps[ent.disk].update(state='scheduled', prevrun=ent.prevrun)
+        elif ent.key == 'DUMP-START' :
+            assert runinfo.dumps[ent.disk].state == 'scheduled'
+            runinfo.dumps[ent.disk].update(state='partial', fname=ent.fname)
+        elif ent.key == 'DUMP-FINISHED' :
+            assert runinfo.dumps[ent.disk].state == 'partial'
+            runinfo.dumps[ent.disk].update(state=DumpState.tostr(ent.state),
+                                           raw_size=ent.raw_size,
+                                           comp_size=ent.comp_size,
+                                           nfiles=ent.nfiles,
+                                           hashtype=ent.hashtype,
+                                           hashsum=ent.hashsum)
+        elif ent.key == 'DUMP-ABORT' :
+            runinfo.dumps[ent.disk].update(state=DumpState.ABORTED)
+        elif ent.key == 'USER-MESSAGE' :
+            runinfo.messages.append((ent.level, ent.message))
+        elif ent.key == 'END' :
+            assert runinfo.end_hrs == 'X'
+            runinfo.update(end_hrs=ent.hrs)
+        else :
+            assert 0, ent
 
 
-    # _analysis_message:
+    # __feed_clean:
+    #
+    def __feed_clean (self, ent) :
+        cleaninfo, fixes = self.clean
+        if self.__feed_message(cleaninfo, ent) :
+            pass
+        elif ent.key == 'DUMP-FIX' :
+            fixes.append((ent.disk, ent.state))
+        else :
+            assert 0, ent
+
+
+    # __feed_message:
     #
     @staticmethod
-    def _analysis_message (runinfo, ent) :
+    def __feed_message (runinfo, ent) :
         if ent.key == 'NOTE' :
             runinfo.notes.append(ent.message)
         elif ent.key == 'STRANGE' :
             runinfo.stranges.append((ent.source, ent.message))
+        elif ent.key == 'STRANGE-SUMMARY' :
+            if ent.kind == 'note' :
+                runinfo.notes.append("%s: %s not recorded (last: %s)" %
+                                     (ent.source, plural(ent.skipped, 'note'),
+                                      ent.last))
+            else :
+                runinfo.strange_summaries.append((ent.source, ent.rule,
+                                                  ent.skipped, ent.last),
+                                                 count=ent.skipped)
         elif ent.key == 'WARNING' :
             runinfo.warnings.append(ent.message)
         elif ent.key == 'ERROR' :
@@ -633,3 +1439,21 @@ class JState :
         else :
             return False
         return True
+
+
+# JState:
+#
+class JState :
+
+
+    # analysis:
+    #
+    # Analyse a list of sessions (see JRunFolder).
+    #
+    @staticmethod
+    def analysis (state, samples=0, tools=('dump', 'clean')) :
+        folder = JRunFolder(samples, tools)
+        for session in state :
+            for ent in session :
+                folder.feed(ent)
+        return folder.finish()
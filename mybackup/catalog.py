@@ -0,0 +1,199 @@
+# catalog.py - persistent per-dump file catalogs
+
+__all__ = [
+    'catalog_fname',
+    'CatalogWriter',
+    'Catalog',
+]
+
+import struct, mmap, fnmatch, re
+
+from mybackup.base import *
+from mybackup.tarindex import TarEntry
+
+
+# File format:
+#
+#   header:  MAGIC, entry count (Q), index offset (Q)
+#   records: path length (H), path (utf-8), then _REC
+#   index:   entry count * record offset (Q)
+#
+# Records are sorted by path (as bytes), so lookups by prefix are a
+# binary search through the index.
+#
+MAGIC = b'MBCAT\x00\x01\x00'
+_HEADER = struct.Struct('<8sQQ')
+_PATHLEN = struct.Struct('<H')
+_REC = struct.Struct('<QqIcQ') # size, mtime, mode, type, offset
+_OFFSET = struct.Struct('<Q')
+
+_RE_GLOB = re.compile(r'[*?\[]')
+
+
+# CatalogError:
+#
+class CatalogError (Exception) :
+    pass
+
+
+# catalog_fname:
+#
+# The catalog of a dump file lives next to it.
+#
+def catalog_fname (dumpfile) :
+    return dumpfile + '.cat'
+
+
+# _norm_path:
+#
+# Paths are stored relative to the disk root, without the leading
+# './' written by the dumper nor the trailing '/' of directories.
+#
+def _norm_path (path) :
+    while path.startswith('./') :
+        path = path[2:]
+    return path.strip('/') or '.'
+
+
+# CatalogWriter:
+#
+# Collect TarEntry objects (it can be used as a TarIndexer handler)
+# and write them sorted to 'fname' on close(). The file is first
+# written as 'fname.tmp' so an interrupted dump never leaves a
+# truncated catalog behind.
+#
+class CatalogWriter :
+
+
+    # __init__:
+    #
+    def __init__ (self, fname) :
+        self.fname = fname
+        self.records = []
+
+
+    # __call__:
+    #
+    def __call__ (self, entry) :
+        path = _norm_path(entry.path).encode('utf-8', 'surrogateescape')
+        self.records.append(_PATHLEN.pack(len(path)) + path +
+                            _REC.pack(entry.size, entry.mtime, entry.mode,
+                                      entry.type.encode('latin-1'),
+                                      entry.offset))
+
+
+    # close:
+    #
+    def close (self) :
+        # the records start with their path length, sort on the path
+        self.records.sort(key=lambda r: r[2:2+_PATHLEN.unpack_from(r)[0]])
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'wb') as f :
+            f.write(_HEADER.pack(MAGIC, 0, 0))
+            offsets = []
+            pos = _HEADER.size
+            for rec in self.records :
+                offsets.append(pos)
+                f.write(rec)
+                pos += len(rec)
+            for o in offsets :
+                f.write(_OFFSET.pack(o))
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, len(offsets), pos))
+        os.rename(tmp, self.fname)
+        self.records = []
+
+
+# Catalog:
+#
+# Read access to a catalog file (through mmap).
+#
+class Catalog :
+
+
+    # __init__:
+    #
+    def __init__ (self, fname) :
+        self.fname = fname
+        with open(fname, 'rb') as f :
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.index = _HEADER.unpack_from(self.map)
+        if magic != MAGIC :
+            self.map.close()
+            raise CatalogError("%s: not a catalog file" % fname)
+
+
+    # close:
+    #
+    def close (self) :
+        self.map.close()
+
+
+    def __enter__ (self) :
+        return self
+
+    def __exit__ (self, tp, exc, tb) :
+        self.close()
+        return False
+
+
+    def __len__ (self) :
+        return self.count
+
+
+    # __path:
+    #
+    def __path (self, n) :
+        pos = _OFFSET.unpack_from(self.map, self.index + n * _OFFSET.size)[0]
+        plen = _PATHLEN.unpack_from(self.map, pos)[0]
+        pos += _PATHLEN.size
+        return self.map[pos:pos+plen], pos + plen
+
+
+    # entry:
+    #
+    def entry (self, n) :
+        path, pos = self.__path(n)
+        size, mtime, mode, tp, offset = _REC.unpack_from(self.map, pos)
+        return TarEntry(path=path.decode('utf-8', 'surrogateescape'),
+                        size=size, mtime=mtime, mode=mode,
+                        type=tp.decode('latin-1'), offset=offset)
+
+
+    # bisect:
+    #
+    # Index of the first entry whose path is >= 'key' (bytes).
+    #
+    def bisect (self, key) :
+        lo, hi = 0, self.count
+        while lo < hi :
+            mid = (lo + hi) // 2
+            if self.__path(mid)[0] < key :
+                lo = mid + 1
+            else :
+                hi = mid
+        return lo
+
+
+    # search:
+    #
+    # Iterate over the entries matching the glob 'pattern'. Only the
+    # range of entries sharing the pattern's literal prefix is
+    # scanned.
+    #
+    def search (self, pattern) :
+        pattern = _norm_path(pattern)
+        m = _RE_GLOB.search(pattern)
+        literal = pattern if m is None else pattern[:m.start()]
+        prefix = literal.encode('utf-8', 'surrogateescape')
+        regex = re.compile(fnmatch.translate(pattern)) if m else None
+        for n in range(self.bisect(prefix), self.count) :
+            path, pos = self.__path(n)
+            if not path.startswith(prefix) :
+                break
+            if regex is None :
+                if path != prefix and not path.startswith(prefix + b'/') :
+                    continue
+            elif not regex.match(path.decode('utf-8', 'surrogateescape')) :
+                continue
+            yield self.entry(n)
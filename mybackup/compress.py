@@ -0,0 +1,432 @@
+# compress.py - in-process compression of the dump stream
+
+__all__ = [
+    'COMPRESSORS',
+    'Compressor',
+    'ParallelCompressor',
+    'seekindex_fname',
+    'SeekIndexError',
+    'read_seekindex',
+    'SeekableReader',
+]
+
+import zlib, bz2, lzma, collections, struct, bisect
+from concurrent.futures import ThreadPoolExecutor
+
+from mybackup.base import *
+
+
+# COMPRESSORS:
+#
+# Supported compression methods: name -> (dump extension, default
+# level, max level).
+#
+COMPRESSORS = {
+    'none':  ('.tar',  0, 0),
+    'gzip':  ('.tgz',  6, 9),
+    'bzip2': ('.tbz2', 9, 9),
+    'xz':    ('.txz',  6, 9),
+}
+
+
+# new_compobj:
+#
+# Create a compression object for 'method', or None if the method
+# does not compress.
+#
+def new_compobj (method, level) :
+    if method == 'none' :
+        return None
+    elif method == 'gzip' :
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif method == 'bzip2' :
+        return bz2.BZ2Compressor(level)
+    elif method == 'xz' :
+        return lzma.LZMACompressor(preset=level)
+    else :
+        assert 0, method
+
+
+# new_decompobj:
+#
+def new_decompobj (method) :
+    if method == 'none' :
+        return None
+    elif method == 'gzip' :
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif method == 'bzip2' :
+        return bz2.BZ2Decompressor()
+    elif method == 'xz' :
+        return lzma.LZMADecompressor()
+    else :
+        assert 0, method
+
+
+# compress_block:
+#
+# Compress 'data' as a complete, self-contained stream (a gzip
+# member, a bzip2 or xz stream). Concatenated blocks can be read back
+# by the standard tools.
+#
+def compress_block (method, level, data) :
+    comp = new_compobj(method, level)
+    return comp.compress(data) + comp.flush()
+
+
+# _timed_compress_block:
+#
+# compress_block() for the pool threads, also returns the time it
+# took.
+#
+def _timed_compress_block (method, level, data) :
+    t0 = time.perf_counter()
+    out = compress_block(method, level, data)
+    return out, time.perf_counter() - t0
+
+
+# Compressor:
+#
+# A file-like object which compresses everything written to it and
+# sends the result to 'fout'. It keeps track of the number of bytes
+# actually written to 'fout' and, if 'hashtype' is set, of their
+# hash. Closing the compressor flushes it and closes 'fout',
+# aborting it only closes 'fout' (the output is then truncated). As a
+# context manager, it is closed on exit, or aborted if an exception
+# was raised. 'comp_time' is the time spent compressing.
+#
+# If 'checkpoint' is not 0, the compressed stream is ended and a new
+# one started every 'checkpoint' bytes of input, and the (input,
+# output) offsets of these access points are kept in 'checkpoints' so
+# a reader can start decompressing from there (see SeekableReader).
+#
+class Compressor :
+
+
+    hashsum = property(lambda s: s.hasher.hexdigest())
+
+
+    # __init__:
+    #
+    def __init__ (self, fout, method, level=-1, hashtype='', checkpoint=0) :
+        assert method in COMPRESSORS, method
+        if level < 0 :
+            level = COMPRESSORS[method][1]
+        assert level <= COMPRESSORS[method][2], (method, level)
+        self.fout = fout
+        self.method = method
+        self.level = level
+        self.hashtype = hashtype
+        self.hasher = hash_new(hashtype) if hashtype else None
+        self.data_size = 0
+        self.raw_size = 0
+        self.checkpoint = checkpoint if method != 'none' else 0
+        self.checkpoints = [(0, 0)]
+        self.comp_time = 0.0
+        self.comp = self._new_compobj()
+
+
+    # _new_compobj:
+    #
+    def _new_compobj (self) :
+        return new_compobj(self.method, self.level)
+
+
+    # write:
+    #
+    def write (self, data) :
+        if self.comp is None :
+            self._output(data)
+        elif not self.checkpoint :
+            t0 = time.perf_counter()
+            out = self.comp.compress(data)
+            self.comp_time += time.perf_counter() - t0
+            self._output(out)
+        else :
+            t0 = time.perf_counter()
+            data = memoryview(data)
+            while data :
+                # only start a new stream when there is data for it
+                if self.raw_size - self.checkpoints[-1][0] >= self.checkpoint :
+                    self._output(self.comp.flush())
+                    self.checkpoints.append((self.raw_size, self.data_size))
+                    self.comp = self._new_compobj()
+                n = self.checkpoint - (self.raw_size - self.checkpoints[-1][0])
+                chunk = data[:n]
+                self._output(self.comp.compress(chunk))
+                self.raw_size += len(chunk)
+                data = data[n:]
+            self.comp_time += time.perf_counter() - t0
+            return
+        self.raw_size += len(data)
+
+
+    # close:
+    #
+    def close (self) :
+        if self.fout is None :
+            return
+        if self.comp is not None :
+            t0 = time.perf_counter()
+            out = self.comp.flush()
+            self.comp_time += time.perf_counter() - t0
+            self._output(out)
+        self.fout.close()
+        self.fout = None
+
+
+    # abort:
+    #
+    def abort (self) :
+        if self.fout is None :
+            return
+        self.fout.close()
+        self.fout = None
+
+
+    def __enter__ (self) :
+        return self
+
+    def __exit__ (self, tp, exc, tb) :
+        if tp is None :
+            self.close()
+        else :
+            self.abort()
+        return False
+
+
+    # write_seekindex:
+    #
+    # Save the access points to 'fname' (call after close()).
+    #
+    def write_seekindex (self, fname) :
+        tmp = fname + '.tmp'
+        with open(tmp, 'wb') as f :
+            f.write(_SEEK_HEADER.pack(_SEEK_MAGIC, self.method.encode('ascii'),
+                                      len(self.checkpoints)))
+            for p in self.checkpoints :
+                f.write(_SEEK_POINT.pack(*p))
+        os.rename(tmp, fname)
+
+
+    # _output:
+    #
+    def _output (self, data) :
+        if not data :
+            return
+        self.fout.write(data)
+        self.data_size += len(data)
+        if self.hasher is not None :
+            self.hasher.update(data)
+
+
+# ParallelCompressor:
+#
+# Same as Compressor, but the input is split in blocks of 'blocksize'
+# bytes which are compressed on a pool of 'nthreads' threads (zlib,
+# bz2 and lzma all release the GIL). Each block becomes a separate
+# stream and the results are written in order, so the output is a
+# standard multi-member file. At most 2*nthreads blocks are in flight
+# at any time. Access points can only be set on block boundaries.
+# 'comp_time' adds up the time of all the threads, so it may be
+# longer than the dump itself.
+#
+class ParallelCompressor (Compressor) :
+
+
+    # __init__:
+    #
+    def __init__ (self, fout, method, level=-1, hashtype='', checkpoint=0,
+                  nthreads=2, blocksize=(1 << 20)) :
+        Compressor.__init__(self, fout, method, level, hashtype, checkpoint)
+        assert method != 'none', method
+        assert nthreads >= 1, nthreads
+        self.nthreads = nthreads
+        self.blocksize = blocksize
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.pool = ThreadPoolExecutor(max_workers=nthreads)
+
+
+    # _new_compobj:
+    #
+    # Blocks get their own compression objects.
+    #
+    def _new_compobj (self) :
+        return None
+
+
+    # write:
+    #
+    def write (self, data) :
+        self.buffer.extend(data)
+        if len(self.buffer) < self.blocksize :
+            return
+        bs = self.blocksize
+        nblocks = len(self.buffer) // bs
+        for n in range(nblocks) :
+            self._submit(bytes(self.buffer[n*bs:(n+1)*bs]))
+        del self.buffer[:nblocks*bs]
+
+
+    # close:
+    #
+    def close (self) :
+        if self.fout is None :
+            return
+        if self.buffer :
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending :
+            self._output_block(*self.pending.popleft())
+        self.pool.shutdown()
+        self.fout.close()
+        self.fout = None
+
+
+    # abort:
+    #
+    # Drop the blocks not compressed yet and wait for the threads.
+    #
+    def abort (self) :
+        if self.fout is None :
+            return
+        self.pool.shutdown(cancel_futures=True)
+        self.pending.clear()
+        self.buffer = bytearray()
+        Compressor.abort(self)
+
+
+    # _submit:
+    #
+    def _submit (self, block) :
+        while len(self.pending) >= 2 * self.nthreads :
+            self._output_block(*self.pending.popleft())
+        self.pending.append((self.raw_size,
+                             self.pool.submit(_timed_compress_block, self.method,
+                                              self.level, block)))
+        self.raw_size += len(block)
+
+
+    # _output_block:
+    #
+    def _output_block (self, raw_offset, future) :
+        data, elapsed = future.result()
+        self.comp_time += elapsed
+        if self.checkpoint and raw_offset - self.checkpoints[-1][0] >= self.checkpoint :
+            self.checkpoints.append((raw_offset, self.data_size))
+        self._output(data)
+
+
+# Seek index files:
+#
+# A small header (magic, method, point count) followed by the
+# (uncompressed offset, compressed offset) pairs of the access
+# points, in order.
+#
+_SEEK_MAGIC = b'MBSEEK\x00\x01'
+_SEEK_HEADER = struct.Struct('<8s8sQ')
+_SEEK_POINT = struct.Struct('<QQ')
+
+
+# SeekIndexError:
+#
+class SeekIndexError (Exception) :
+    pass
+
+
+# seekindex_fname:
+#
+def seekindex_fname (dumpfile) :
+    return dumpfile + '.seek'
+
+
+# read_seekindex:
+#
+# Return (method, points) from a seek index file.
+#
+def read_seekindex (fname) :
+    with open(fname, 'rb') as f :
+        data = f.read()
+    magic, method, count = _SEEK_HEADER.unpack_from(data)
+    if magic != _SEEK_MAGIC :
+        raise SeekIndexError("%s: not a seek index file" % fname)
+    points = [_SEEK_POINT.unpack_from(data, _SEEK_HEADER.size + n * _SEEK_POINT.size)
+              for n in range(count)]
+    return method.rstrip(b'\0').decode('ascii'), points
+
+
+# SeekableReader:
+#
+# A read-only file-like object returning the uncompressed data of a
+# dump from 'offset' on, starting the decompression at the closest
+# access point before it.
+#
+class SeekableReader :
+
+
+    # __init__:
+    #
+    def __init__ (self, fname, method, points=((0, 0),), offset=0) :
+        self.method = method
+        self.f = open(fname, 'rb')
+        if method == 'none' :
+            raw, comp = offset, offset
+        else :
+            n = bisect.bisect_right([p[0] for p in points], offset) - 1
+            raw, comp = points[n]
+        self.f.seek(comp)
+        self.decomp = new_decompobj(method)
+        self.skip = offset - raw
+        self.buffer = bytearray()
+        self.eof = False
+
+
+    # close:
+    #
+    def close (self) :
+        self.f.close()
+
+
+    def __enter__ (self) :
+        return self
+
+    def __exit__ (self, tp, exc, tb) :
+        self.close()
+        return False
+
+
+    # read:
+    #
+    def read (self, size=-1) :
+        while (size < 0 or len(self.buffer) < size) and not self.eof :
+            self.__fill()
+        if size < 0 :
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+    # __fill:
+    #
+    def __fill (self) :
+        data = self.f.read(1 << 16)
+        if not data :
+            self.eof = True
+            return
+        if self.decomp is None :
+            out = data
+        else :
+            out = b''
+            while data :
+                out += self.decomp.decompress(data)
+                if not self.decomp.eof :
+                    break
+                # end of a stream, the next one may follow
+                data = self.decomp.unused_data
+                self.decomp = new_decompobj(self.method)
+        if self.skip :
+            n = min(self.skip, len(out))
+            out = out[n:]
+            self.skip -= n
+        self.buffer.extend(out)
@@ -9,6 +9,7 @@ import os, json, collections
 from mybackup.base import *
 from mybackup.log import *
 from mybackup.tools import *
+from mybackup.compress import COMPRESSORS, Compressor, ParallelCompressor
 from mybackup.sysconf import SYSCONF
 
 
@@ -76,6 +77,19 @@ class Config :
         self.check_file = conf.pop('check_file', '')
         self.dump_delay = conf.pop('dump_delay', '1d')
         self.retry_delay = conf.pop('retry_delay', '1d')
+        self.max_parallel_dumps = int(conf.pop('max_parallel_dumps', 1))
+        assert self.max_parallel_dumps >= 1, self.max_parallel_dumps
+        # max number of strange/note lines recorded in the journal
+        # for a run (the others are only counted), see StrangeBudget
+        self.strange_limit = int(conf.pop('strange_limit', 1000))
+        assert self.strange_limit >= 0, self.strange_limit
+        # format of the new journals (the readers detect it)
+        self.journal_format = conf.pop('journal_format', 'text')
+        assert self.journal_format in ('text', 'binary'), self.journal_format
+        # max number of errors, warnings, strange lines and notes
+        # listed in the report (the others are only counted)
+        self.report_samples = int(conf.pop('report_samples', 100))
+        assert self.report_samples >= 0, self.report_samples
         self.report_columns = tuple(conf.pop('report_columns',
                                        (r'\title=DISK\%(disk)s',
                                         r'\title=STATE\center\%(upstate)s',
@@ -148,6 +162,16 @@ class CfgDisk :
         self.orig = conf.pop('orig', '')
         self.hooks = conf.pop('hooks', [])
         self.dumpdir = conf.pop('dumpdir', self.name) # [fixme]
+        self.device_group = conf.pop('device_group', '')
+        self.compress = conf.pop('compress', 'gzip')
+        self.compress_level = int(conf.pop('compress_level', -1))
+        self.compress_threads = int(conf.pop('compress_threads', 1))
+        # distance between two access points in the compressed dump,
+        # in MiB (0 disables the seek index)
+        self.checkpoint_interval = int(conf.pop('checkpoint_interval', 16))
+        assert self.compress in COMPRESSORS, self.compress
+        assert self.compress_threads >= 1, self.compress_threads
+        assert self.checkpoint_interval >= 0, self.checkpoint_interval
         assert not conf, conf
         # [removeme]
         # for n, v in dconf.items() :
@@ -161,6 +185,38 @@ class CfgDisk :
         return DumperTar()
 
 
+    # get_compressor:
+    #
+    # Return a compressor writing to 'fout', configured for this disk.
+    #
+    def get_compressor (self, fout, hashtype='') :
+        checkpoint = self.checkpoint_interval << 20
+        if self.compress_threads > 1 and self.compress != 'none' :
+            return ParallelCompressor(fout, self.compress, self.compress_level,
+                                      hashtype=hashtype, checkpoint=checkpoint,
+                                      nthreads=self.compress_threads)
+        return Compressor(fout, self.compress, self.compress_level,
+                          hashtype=hashtype, checkpoint=checkpoint)
+
+
+    # get_device_group:
+    #
+    # Return the name of the group of disks which share the same
+    # physical device. Dumps in the same group are never run at the
+    # same time. If not set in the config, disks are grouped by the
+    # device their path lives on.
+    #
+    def get_device_group (self) :
+        if self.device_group :
+            return self.device_group
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # the dump will fail anyway, keep it alone
+            return 'disk:%s' % self.name
+        return 'dev:%d' % st.st_dev
+
+
     # get_dumpname:
     #
     def get_dumpname (self, runid, level, prevrun, hrs, state) :
@@ -179,8 +235,7 @@ class CfgDisk :
     # get_dumpext:
     #
     def get_dumpext (self) :
-        # [fixme]
-        return '.tgz'
+        return COMPRESSORS[self.compress][0]
 
 
     # [fixme] should be elsewhere
@@ -195,7 +250,9 @@ class CfgDisk :
         
     # run_hooks:
     #
-    def run_hooks (self, trigger, journal) :
+    # 'budget' is the StrangeBudget of the run.
+    #
+    def run_hooks (self, trigger, journal, budget=None) :
         for hook in self.hooks :
             if not self._match_trigger(trigger, hook['triggers']) :
                 continue
@@ -214,14 +271,26 @@ class CfgDisk :
             proc = cmdexec(cmd, cwd=self.config.cfgdir,
                            stdout=CMDPIPE, stderr=CMDPIPE)
             name = 'hook.%s.%s.%s' % (self.name, trigger, script.name)
-            parser = StrangeParser(name, journal, script.rules)
-            pout = PipeThread(name, proc.stdout, (),
-                              line_handler=parser, started=True)
-            perr = PipeThread(name, proc.stderr, (),
-                              line_handler=parser, started=True)
-            pout.join()
-            perr.join()
+            parser = StrangeParser(name, journal, script.rules,
+                                   budget=budget)
+            loop = PipeLoop(name)
+            pout = PipeThread(name, proc.stdout, (), line_handler=parser,
+                              loop=loop, started=True)
+            perr = PipeThread(name, proc.stderr, (), line_handler=parser,
+                              loop=loop, started=True)
+            errors = []
+            for p in (pout, perr) :
+                try:
+                    p.join()
+                except Exception as exc:
+                    # kill the hook so that its other pipe ends too
+                    if not errors :
+                        proc.kill()
+                    errors.append(exc)
+            parser.close()
             r = proc.wait()
+            if errors :
+                raise errors[0]
             assert r == 0, (self.config.start_hrs, r, self, hook)
 
 
@@ -2,9 +2,14 @@
 
 __all__ = [
     'Journal',
+    'JOURNAL_FORMATS',
+    'iter_journal_file',
+    'read_journal_file',
+    'fold_journal',
+    'write_journal_file',
 ]
 
-import logging
+import logging, zlib, re, struct, mmap, gc
 from collections import namedtuple
 
 from mybackup.base import *
@@ -20,6 +25,9 @@ class JournalNotFoundError (Exception) :
 class JournalRollError (Exception) :
     pass
 
+class JournalChecksumError (Exception) :
+    pass
+
         
 # LogJournalHandler:
 #
@@ -62,11 +70,547 @@ class LogJournalHandler (LogBaseHandler) :
         j.record(key, message=rec.message)
 
 
+# (un)escaping:
+#
+# Field values can't contain the separator nor a newline, these (and
+# the backslash) are written as '\xNN'. Chained str.replace() calls
+# are much faster than str.translate() here (which looks each char
+# up in a dict), the backslash must come first.
+#
+_RE_ESCAPED = re.compile(r'\\x([0-9a-fA-F]{2})')
+
+def _escape (v) :
+    return v.replace('\\', '\\x5c').replace(':', '\\x3a').replace('\n', '\\x0a')
+
+def _unescape_char (m) :
+    return chr(int(m.group(1), 16))
+
+def _unescape (v) :
+    if '\\' not in v :
+        return v
+    # the common case: only the chars escaped by _escape(), every
+    # backslash starts an escape so the order does not matter as
+    # long as '\x5c' comes last
+    r = v.replace('\\x3a', ':').replace('\\x0a', '\n')
+    if r.count('\\') == r.count('\\x5c') :
+        return r.replace('\\x5c', '\\')
+    r = _RE_ESCAPED.sub(_unescape_char, v)
+    assert '\\' not in _RE_ESCAPED.sub('', v), v
+    return r
+
+
+# converters:
+#
+# Field types -> (adapter, converter). Adapters get the raw
+# (escaped) field string, converters return it.
+#
+def _adapt_uint (v) :
+    r = int(v)
+    assert r > 0, v
+    return r
+
+def _convert_str (v) :
+    assert isinstance(v, str), v
+    return _escape(v)
+
+def _convert_int (v) :
+    assert isinstance(v, int), v
+    return str(v)
+
+def _convert_uint (v) :
+    assert isinstance(v, int), v
+    assert v > 0, v
+    return str(v)
+
+_FIELD_TYPES = {
+    'str':       (_unescape, _convert_str),
+    'int':       (int, _convert_int),
+    'uint':      (_adapt_uint, _convert_uint),
+    'hrs':       (lambda v: check_hrs(_unescape(v)), lambda v: _escape(check_hrs(v))),
+    'dumpstate': (DumpState.tostr, DumpState.tostr),
+}
+
+_ADAPTERS = dict((t, a) for t, (a, c) in _FIELD_TYPES.items())
+_CONVERTERS = dict((t, c) for t, (a, c) in _FIELD_TYPES.items())
+
+
+# binary fields:
+#
+# Field types -> (decoder, encoder) code templates for the binary
+# format. Decoders read field 'f%(i)d' from the payload 'b' at 'p'
+# and move 'p' forward, encoders append entry field 'e[%(j)d]' to
+# 'out'.
+#
+_BIN_FIELDS = {
+    'str': ("n, = U32(b, p) ; f%(i)d = b[p+4:p+4+n].decode('utf-8') ; p += 4 + n",
+            "x = e[%(j)d].encode('utf-8') ; out.append(U32P(len(x))) ; out.append(x)"),
+    'int': ("f%(i)d, = I64(b, p) ; p += 8",
+            "out.append(I64P(e[%(j)d]))"),
+    'uint': ("f%(i)d, = U64(b, p) ; p += 8",
+             "out.append(U64P(e[%(j)d]))"),
+    'hrs': ("f%(i)d = b[p:p+14].decode('ascii') ; p += 14",
+            "out.append(e[%(j)d].encode('ascii'))"),
+    'dumpstate': ("f%(i)d = DS(b[p]) ; p += 1",
+                  "out.append(bytes((DI(e[%(j)d]),)))"),
+}
+
+_BIN_NAMESPACE = {
+    'U32': struct.Struct('<I').unpack_from,
+    'U32P': struct.Struct('<I').pack,
+    'I64': struct.Struct('<q').unpack_from,
+    'I64P': struct.Struct('<q').pack,
+    'U64': struct.Struct('<Q').unpack_from,
+    'U64P': struct.Struct('<Q').pack,
+    'DS': DumpState.tostr,
+    'DI': DumpState.toint,
+}
+
+
+# _BIN_KEYIDS:
+#
+# The key ids of the binary format - never change or reuse them!
+#
+_BIN_KEYIDS = {
+    '_OPEN': 1,
+    '_CLOSE': 2,
+    'START': 3,
+    'END': 4,
+    'SELECT': 5,
+    'SCHEDULE': 6,
+    'DUMP-START': 7,
+    'DUMP-FINISHED': 8,
+    'DUMP-ABORT': 9,
+    'STRANGE': 10,
+    'STRANGE-SUMMARY': 11,
+    'NOTE': 12,
+    'WARNING': 13,
+    'ERROR': 14,
+    'USER-MESSAGE': 15,
+    'CLEAN-START': 16,
+    'CLEAN-END': 17,
+    'CLEAN-PANIC': 18,
+    'DUMP-FIX': 19,
+}
+
+
+# _KeyCodec:
+#
+# Parser and formatter of the records of one key, compiled from its
+# spec so a line is turned into its namedtuple (and back) without
+# any per field lookup:
+#
+#   parse(fields) -> entry  ('fields' is the list of raw values)
+#   encode(kwargs) -> (entry, line)
+#   parse_bin(payload) -> entry
+#   encode_bin(entry) -> payload
+#
+# A spec is a list of (name, type) fields, the last ones may be
+# optional (name, type, default): records written before they were
+# added get the default, new ones always have all the fields.
+#
+class _KeyCodec :
+
+
+    # __init__:
+    #
+    def __init__ (self, key, kspecs) :
+        self.key = key
+        self.kspecs = tuple(p[:2] for p in kspecs)
+        self.defaults = tuple(p[2] for p in kspecs if len(p) > 2)
+        self.nrequired = len(kspecs) - len(self.defaults)
+        assert all(len(p) == 2 for p in kspecs[:self.nrequired]), kspecs
+        self.keyid = _BIN_KEYIDS[key]
+        self.ktype = namedtuple('JournalKey_' + key.replace('-', '_'),
+                                ('key',) + tuple(p[0] for p in kspecs))
+        self.__compile_text()
+        self.__compile_bin()
+
+
+    # __compile_text:
+    #
+    def __compile_text (self) :
+        key, kspecs, nreq = self.key, self.kspecs, self.nrequired
+        ns = {'T': self.ktype, 'K': key, 'N': len(kspecs), 'NREQ': nreq}
+        for i, (pname, ptype) in enumerate(kspecs) :
+            ns['A%d' % i] = _ADAPTERS[ptype]
+            ns['C%d' % i] = _CONVERTERS[ptype]
+            if i >= nreq :
+                ns['D%d' % i] = self.defaults[i - nreq]
+        # the raw values of the missing optional fields
+        ns['RAW'] = [_CONVERTERS[kspecs[i][1]](ns['D%d' % i])
+                     for i in range(nreq, len(kspecs))]
+        fields = ''.join('f%d, ' % i for i in range(len(kspecs)))
+        values = ''.join('v%d, ' % i for i in range(len(kspecs)))
+        src = ['def parse (fields) :']
+        if self.defaults :
+            src.extend(['    if len(fields) < N :',
+                        '        assert len(fields) >= NREQ, fields',
+                        '        fields = fields + RAW[len(fields) - NREQ:]'])
+        src.extend(['    %s = fields' % fields,
+                    '    return T(K, %s)' % ', '.join('A%d(f%d)' % (i, i)
+                                                       for i in range(len(kspecs))),
+                    'def encode (kw) :'])
+        if self.defaults :
+            src.append('    assert NREQ <= len(kw) <= N, kw')
+        else :
+            src.append('    assert len(kw) == N, kw')
+        src.extend(('    v%d = kw[%r]' % (i, pname)) if i < nreq else
+                   ('    v%d = kw.get(%r, D%d)' % (i, pname, i))
+                   for i, (pname, ptype) in enumerate(kspecs))
+        src.append('    return T(K, %s), K + %s' %
+                   (values, ' + '.join("':' + C%d(v%d)" % (i, i)
+                                       for i in range(len(kspecs)))))
+        exec('\n'.join(src), ns)
+        self.parse = ns['parse']
+        self.encode = ns['encode']
+
+
+    # __compile_bin:
+    #
+    # Payload: key id (1 byte) then the fields. The optional fields
+    # are read only if the payload is long enough.
+    #
+    def __compile_bin (self) :
+        nreq = self.nrequired
+        ns = dict(_BIN_NAMESPACE, T=self.ktype, K=self.key,
+                  KID=bytes((self.keyid,)))
+        src = ['def parse_bin (b) :',
+               '    p = 1']
+        for i, (pname, ptype) in enumerate(self.kspecs) :
+            if i < nreq :
+                src.append('    ' + (_BIN_FIELDS[ptype][0] % {'i': i}))
+            else :
+                ns['D%d' % i] = self.defaults[i - nreq]
+                src.append('    if p < len(b) : ' + (_BIN_FIELDS[ptype][0] % {'i': i}))
+                src.append('    else : f%d = D%d' % (i, i))
+        src.append('    assert p == len(b), (p, len(b))')
+        src.append('    return T(K, %s)' % ''.join('f%d, ' % i for i in range(len(self.kspecs))))
+        src.append('def encode_bin (e) :')
+        src.append('    out = [KID]')
+        src.extend('    ' + (_BIN_FIELDS[ptype][1] % {'j': i + 1})
+                   for i, (pname, ptype) in enumerate(self.kspecs))
+        src.append("    return b''.join(out)")
+        exec('\n'.join(src), ns)
+        self.parse_bin = ns['parse_bin']
+        self.encode_bin = ns['encode_bin']
+
+
+    # format_line:
+    #
+    # The text line of an entry.
+    #
+    def format_line (self, entry) :
+        return self.encode(dict(zip(entry._fields[1:], entry[1:])))[1]
+
+
+# _TextFormat:
+#
+# One record per line: '%08x ' (the crc32 of the record), then the
+# key and the fields separated by ':'. Lines without a checksum
+# (written by older versions) are still accepted.
+#
+class _TextFormat :
+
+
+    NAME = 'text'
+    HEADER = b''
+
+    _RE_CHECKSUM = re.compile(rb'[0-9a-f]{8} ')
+
+
+    # encode:
+    #
+    def encode (self, codec, entry, line) :
+        body = line.encode('utf-8')
+        return b'%08x %s\n' % (zlib.crc32(body), body)
+
+
+    # records:
+    #
+    # Parse the records of 'buf' from 'pos' and generate (end, entry,
+    # error) tuples. A last line without its newline, or whose
+    # checksum is wrong, is a record torn by a crash: it stops the
+    # parsing without being reported.
+    #
+    def records (self, buf, pos) :
+        size = len(buf)
+        codecs = Journal.CODECS
+        while pos < size :
+            nl = buf.find(b'\n', pos)
+            if nl < 0 :
+                return
+            raw = buf[pos:nl]
+            pos = nl + 1
+            try:
+                line = self.__check_line(raw)
+            except (UnicodeDecodeError, JournalChecksumError):
+                if pos == size :
+                    return
+                yield pos, None, 'invalid journal line: %r' % raw
+                continue
+            if not line :
+                yield pos, None, None
+                continue
+            try:
+                key, sep, fields = line.partition(':')
+                entry = codecs[key].parse(fields.split(':'))
+            except Exception as exc:
+                yield pos, None, "invalid journal line: '%s' (%s)" % (line, exc_name(exc))
+                continue
+            yield pos, entry, None
+
+
+    # __check_line:
+    #
+    # Check and strip the checksum of a raw line, return the record.
+    #
+    def __check_line (self, raw) :
+        if self._RE_CHECKSUM.match(raw) is None :
+            # no checksum (old journal)
+            return raw.decode('utf-8').strip()
+        body = raw[9:]
+        if int(raw[:8], 16) != zlib.crc32(body) :
+            raise JournalChecksumError()
+        return body.decode('utf-8')
+
+
+# _BinaryFormat:
+#
+# A header (HEADER), then the records: payload length (u32), payload
+# (see _KeyCodec.encode_bin()), crc32 of the payload (u32).
+#
+class _BinaryFormat :
+
+
+    NAME = 'binary'
+    HEADER = b'MBJRNL\x00\x01'
+
+    _U32 = struct.Struct('<I')
+
+
+    # encode:
+    #
+    def encode (self, codec, entry, line) :
+        payload = codec.encode_bin(entry)
+        return b''.join((self._U32.pack(len(payload)), payload,
+                         self._U32.pack(zlib.crc32(payload))))
+
+
+    # records:
+    #
+    # See _TextFormat.records(). A record going past the end of the
+    # file, or whose checksum is wrong and which is the last one, is
+    # a torn record.
+    #
+    def records (self, buf, pos) :
+        size = len(buf)
+        u32 = self._U32.unpack_from
+        codecs = Journal.BIN_CODECS
+        while pos + 4 <= size :
+            n, = u32(buf, pos)
+            end = pos + n + 8
+            if end > size :
+                return
+            payload = buf[pos+4:pos+4+n]
+            crc, = u32(buf, pos + 4 + n)
+            if n == 0 or crc != zlib.crc32(payload) :
+                if end == size :
+                    return
+                yield end, None, 'offset %d: invalid record checksum' % pos
+                pos = end
+                continue
+            try:
+                entry = codecs[payload[0]].parse_bin(payload)
+            except Exception as exc:
+                yield end, None, 'offset %d: invalid record (%s)' % (pos, exc_name(exc))
+            else:
+                yield end, entry, None
+            pos = end
+
+
+# JOURNAL_FORMATS:
+#
+JOURNAL_FORMATS = {
+    'text': _TextFormat(),
+    'binary': _BinaryFormat(),
+}
+
+
+# _detect_format:
+#
+def _detect_format (buf) :
+    hdr = _BinaryFormat.HEADER
+    return 'binary' if buf[:len(hdr)] == hdr else 'text'
+
+
+# iter_journal_file:
+#
+# Generate the entries of a journal file as they are parsed, without
+# any locking nor session processing. 'info' gets the format of the
+# file.
+#
+def iter_journal_file (fname, info=None) :
+    with open(fname, 'rb') as f :
+        if os.fstat(f.fileno()).st_size == 0 :
+            if info is not None :
+                info['format'] = 'text'
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf :
+            fmtname = _detect_format(buf)
+            if info is not None :
+                info['format'] = fmtname
+            fmt = JOURNAL_FORMATS[fmtname]
+            pos = len(fmt.HEADER)
+            for pos, entry, err in fmt.records(buf, len(fmt.HEADER)) :
+                if err :
+                    error("%s: %s" % (fname, err))
+                elif entry is not None :
+                    yield entry
+            if pos < len(buf) :
+                warning("%s: ignoring torn journal record" % fname)
+
+
+# read_journal_file:
+#
+# Return the format and the list of entries of a journal file (see
+# iter_journal_file).
+#
+def read_journal_file (fname) :
+    info = {}
+    entries = list(iter_journal_file(fname, info))
+    return info['format'], entries
+
+
+# fold_journal:
+#
+# Feed the entries of a journal file to 'folder' (a JRunFolder) as
+# they are parsed, with the journal lock held, and return its result.
+# Unlike Journal, no entry is kept in memory.
+#
+def fold_journal (fname, lockfile, folder) :
+    if not os.path.exists(fname) :
+        raise JournalNotFoundError(fname)
+    with FLock(lockfile) :
+        for entry in iter_journal_file(fname) :
+            folder.feed(entry)
+    return folder.finish()
+
+
+# write_journal_file:
+#
+# Write the entries to a new journal file.
+#
+def write_journal_file (fname, entries, fmtname) :
+    fmt = JOURNAL_FORMATS[fmtname]
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    with open(fd, 'wb') as f :
+        f.write(fmt.HEADER)
+        for entry in entries :
+            codec = Journal.CODECS[entry.key]
+            f.write(fmt.encode(codec, entry, codec.format_line(entry)))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# _JournalState:
+#
+# The parsed content of a journal file. It is shared by all the
+# Journal instances of the process which use the same file, so that
+# opening it again (or writing to it) only parses the records added
+# since by the other processes. 'offset' is the end of the part
+# already parsed and 'nlines' its number of lines.
+#
+class _JournalState :
+
+
+    # __init__:
+    #
+    def __init__ (self, dev, ino) :
+        self.dev = dev
+        self.ino = ino
+        self.format = None
+        self.offset = 0
+        self.nlines = 0
+        self.sessions = []
+        self.curss = None
+        self.lock = threading.RLock()
+
+
+    # apply:
+    #
+    # Add an entry to the sessions (the lock must be held).
+    #
+    def apply (self, entry) :
+        if entry.key == '_OPEN' :
+            if self.curss is not None :
+                trace("journal: session was not closed: %s" % repr(self.curss[0]))
+            self.curss = [entry]
+            self.sessions.append(self.curss)
+        elif entry.key == '_CLOSE' :
+            assert self.curss is not None
+            assert self.curss[0].tool == entry.tool
+            self.curss = None
+        else :
+            assert self.curss is not None
+            self.curss.append(entry)
+
+
+# file path -> _JournalState
+_STATES = {}
+_STATES_LOCK = threading.Lock()
+
+
+# _get_state:
+#
+# Return the state of journal 'fname' whose stat() result is 'st'. A
+# new state is created if the file changed under our feet (it is not
+# the same inode or it shrank).
+#
+def _get_state (fname, st, new=False) :
+    key = os.path.abspath(fname)
+    with _STATES_LOCK :
+        js = _STATES.get(key)
+        if new or js is None or (js.dev, js.ino) != (st.st_dev, st.st_ino) \
+          or st.st_size < js.offset :
+            js = _STATES[key] = _JournalState(st.st_dev, st.st_ino)
+        return js
+
+
+# _forget_state:
+#
+def _forget_state (fname) :
+    with _STATES_LOCK :
+        _STATES.pop(os.path.abspath(fname), None)
+
+
 # Journal:
 #
+# The journal file is written in append mode only, in text (one
+# record per line, the default) or binary format (see _TextFormat and
+# _BinaryFormat). Readers detect the format of the file. Each record
+# carries a crc32, so a record torn by a crash can be detected (and
+# dropped) when the file is read again.
+#
+# The parsed records (state2, a list of sessions) are shared by all
+# the instances of the process which use the same file, see
+# _JournalState.
+#
+# Records are made durable before record() returns, but concurrent
+# writers share their fsync (group commit): while one thread syncs
+# the file, the records written by the others wait for the next
+# sync, which covers all of them.
+#
 class Journal :
 
 
+    # how long the syncing thread waits for the records of the other
+    # writers before syncing
+    COMMIT_WINDOW = 0.005
+
+    # how long to wait for the journal lock before giving up
+    LOCK_TIMEOUT = 300
+
+
     KEYSPECS = {
         '_OPEN': (('tool', 'str'),
                   ('hrs', 'hrs'),
@@ -95,13 +639,24 @@ class Journal :
                           ('comp_size', 'int'),
                           ('nfiles',    'int'),
                           ('hashtype', 'str'),
-                          ('hashsum', 'str')),
+                          ('hashsum', 'str'),
+                          # when the dump started and finished (unix
+                          # time), 0 in the older journals
+                          ('start_time', 'int', 0),
+                          ('end_time', 'int', 0)),
 
         'DUMP-ABORT': (('disk', 'str'),),
 
         'STRANGE': (('source', 'str'),
                     ('message', 'str')),
 
+        # lines of a rule which were not recorded as STRANGE/NOTE
+        'STRANGE-SUMMARY': (('source', 'str'),
+                            ('rule', 'str'),
+                            ('kind', 'str'),
+                            ('skipped', 'uint'),
+                            ('last', 'str')),
+
         'NOTE': (('message', 'str'),),
 
         'WARNING': (('message', 'str'),),
@@ -124,12 +679,19 @@ class Journal :
     }
 
 
-    KEYTYPES = dict((n, namedtuple('JournalKey_'+n.replace('-', '_'),
-                                   ('key',) + tuple(p[0] for p in kspecs)))
-                    for n, kspecs in KEYSPECS.items())
+    # one codec per key, see _KeyCodec
+    CODECS = dict((n, _KeyCodec(n, kspecs)) for n, kspecs in KEYSPECS.items())
+
+    KEYTYPES = dict((n, c.ktype) for n, c in CODECS.items())
+
+    BIN_CODECS = dict((c.keyid, c) for c in CODECS.values())
+
+
+    flock = property(lambda s: s.lock)
 
+    lock_stats = property(lambda s: s.lock.stats)
 
-    flock = property(lambda s: FLock(s.lockfile))
+    state2 = property(lambda s: s.jstate.sessions)
 
 
     # adapt:
@@ -139,10 +701,7 @@ class Journal :
     @staticmethod
     def adapt (t, v) :
         assert isinstance(v, str), v
-        u = Journal.__unescape(v)
-        n = '_Journal__adapt_' + t
-        h = getattr(Journal, n)
-        return h(u)
+        return _ADAPTERS[t](v)
 
 
     # convert:
@@ -151,102 +710,35 @@ class Journal :
     #
     @staticmethod
     def convert (t, v) :
-        n = '_Journal__convert_' + t
-        h = getattr(Journal, n)
-        r = h(v)
+        r = _CONVERTERS[t](v)
         assert isinstance(r, str), v
-        return Journal.__escape(r)
-
-
-    # converters:
-    #
-    @staticmethod
-    def __adapt_str (v) :
-        return v
-    
-    @staticmethod
-    def __convert_str (v) :
-        assert isinstance(v, str), v
-        return v
-
-    @staticmethod
-    def __adapt_int (v) :
-        return int(v)
-
-    @staticmethod
-    def __convert_int (v) :
-        assert isinstance(v, int), v
-        return str(v)
-
-    @staticmethod
-    def __adapt_uint (v) :
-        r = int(v)
-        assert r > 0, v
         return r
 
-    @staticmethod
-    def __convert_uint (v) :
-        assert isinstance(v, int), v
-        assert v > 0, v
-        return str(v)
-
-    @staticmethod
-    def __adapt_hrs (v) :
-        return check_hrs(v)
-
-    @staticmethod
-    def __convert_hrs (v) :
-        return check_hrs(v)
-
-    @staticmethod
-    def __adapt_dumpstate (v) :
-        return DumpState.tostr(v)
-
-    @staticmethod
-    def __convert_dumpstate (v) :
-        return DumpState.tostr(v)
-
-
-    # (un)escaping:
-    #
-    @staticmethod
-    def __escape (line) :
-        chars = "\\:\n"
-        out = ''
-        for c in line :
-            if c in chars :
-                out += "\\x%02x" % ord(c)
-            else :
-                out += c
-        return out
-
-    @staticmethod
-    def __unescape (line) :
-        out, pos = '', 0
-        while True :
-            i = line.find("\\", pos)
-            if i < 0 :
-                out += line[pos:]
-                return out
-            out += line[pos:i]
-            assert line[i+1] == 'x'
-            char = int(line[i+2:i+4], 16)
-            out += chr(char)
-            pos = i + 4
-
 
     # __init__:
     #
     # [FIXME] LOCKING IS WRONG!
     #
-    def __init__ (self, fname, mode, tool_name, lockfile) :
+    def __init__ (self, fname, mode, tool_name, lockfile, fmt='text') :
+        assert fmt in JOURNAL_FORMATS, fmt
+        self.format = fmt # for new files only
         self.lockfile = lockfile
+        # writers keep the lock file open (see __doopen)
+        self.lock = FLock(lockfile, timeout=Journal.LOCK_TIMEOUT)
         self.tlock = threading.Lock() # useless ?
         self.fname = fname
         self.mode = mode
         self.tool_name = tool_name
         self.log_handler = None
         self.__open = False
+        self.fd = -1
+        self.jstate = None
+        # group commit state
+        self.wcond = threading.Condition()
+        self.nwriters = 0   # writers which have not written their record yet
+        self.wseq = 0       # number of records written
+        self.synced = 0     # number of records known to be on disk
+        self.syncing = False
         self.__doopen()
 
 
@@ -261,30 +753,39 @@ class Journal :
         logger = logging.getLogger(log_domain())
         assert not self.isopen()
         self.__open = True
-        # new style
-        self.state2 = []
-        self.curss = None
-        #
         if self.mode == 'w' :
             # [FIXME] !!
             trace("opening journal '%s' for writing" % self.fname)
+            self.lock.open()
             with self.flock :
-                fd = os.open(self.fname, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
-                os.close(fd)
+                self.fd = os.open(self.fname, os.O_WRONLY | os.O_CREAT |
+                                  os.O_EXCL | os.O_APPEND, 0o644)
+                self.jstate = _get_state(self.fname, os.fstat(self.fd), new=True)
+                self.jstate.format = self.format
+                header = JOURNAL_FORMATS[self.format].HEADER
+                if header :
+                    os.write(self.fd, header)
+                    self.jstate.offset = len(header)
             # captures all log errors and warnings
             self.__install_log_handler()
             # record open
             self.record('_OPEN', tool=self.tool_name, hrs=stamp2hrs(int(time.time())), mode='w')
         elif self.mode == 'a' :
             trace("opening journal '%s' for (append) writing" % self.fname)
+            self.lock.open()
             with self.flock :
-                self.__read_file()
+                size = self.__load_state()
+                if self.jstate.offset < size :
+                    warning("%s: dropping a torn record at the end of the journal" %
+                            self.fname)
+                    os.truncate(self.fname, self.jstate.offset)
+                self.fd = os.open(self.fname, os.O_WRONLY | os.O_APPEND)
             # captures all log errors and warnings
             self.__install_log_handler()
             self.record('_OPEN', tool=self.tool_name, hrs=stamp2hrs(int(time.time())), mode='a')
         elif self.mode == 'r' :
             with self.flock :
-                self.__read_file()
+                self.__load_state()
             self.__open = False # ?
         else :
             assert 0, self.mode
@@ -302,8 +803,8 @@ class Journal :
     # get_state:
     #
     def get_state (self) :
-        with self.tlock :
-            return self.state2[:]
+        with self.jstate.lock :
+            return self.jstate.sessions[:]
 
 
     # isopen:
@@ -334,66 +835,109 @@ class Journal :
                 logger = logging.getLogger(log_domain())
                 logger.removeHandler(self.log_handler)
                 self.log_handler = None
+        with self.wcond :
+            if self.fd >= 0 :
+                os.close(self.fd)
+                self.fd = -1
+                trace("journal lock: %s" % self.lock.stats)
+        self.lock.close()
 
 
     # delete:
     #
     def delete (self) :
         warning("[FIXME] Journal.delete()")
+        _forget_state(self.fname)
         os.unlink(self.fname)
 
         
     # roll:
     #
+    # Returns the name of the rolled file.
+    #
     # [FIXME] we should have a 'closed' flag to make sure we don't
     # read/write after a roll!
     #
     def roll (self, dirname, sfx) :
         assert sfx
         with self.flock :
-            self.__roll(dirname, sfx)
+            return self.__roll(dirname, sfx)
+
+
+    # __load_state:
+    #
+    # Attach the shared state of the file and parse the records added
+    # since it was last read. Returns the file size. Must be called
+    # with the file lock held.
+    #
+    def __load_state (self) :
+        try:
+            st = os.stat(self.fname)
+        except FileNotFoundError:
+            raise JournalNotFoundError(self.fname)
+        self.jstate = _get_state(self.fname, st)
+        with self.jstate.lock :
+            if st.st_size > self.jstate.offset :
+                self.__read_file()
+            elif self.jstate.format is None :
+                # empty file
+                self.jstate.format = 'text'
+        return st.st_size
 
 
     # __read_file:
     #
+    # Parse the file from the state's offset.
+    #
     def __read_file (self) :
         try:
-            f = open(self.fname, 'rt')
+            f = open(self.fname, 'rb')
         except FileNotFoundError:
             raise JournalNotFoundError(self.fname)
-        try:
-            self.__read(f, self.fname)
-        finally:
-            f.close()
+        with f :
+            if os.fstat(f.fileno()).st_size <= self.jstate.offset :
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf :
+                self.__read(buf, self.fname)
 
 
     # __read:
     #
-    def __read (self, f, fname) :
-        trace("parsing journal lines")
-        for lno, line in enumerate(f) :
-            line = line.strip()
-            if not line : continue
-            try:
-                self.__read_line2(line)
-            except Exception:
-                exception("%s:%d: invalid journal line: '%s'" %
-                          (fname, lno+1, line))
-                continue
-
-    def __read_line2 (self, line) :
-        trace("<< `%s'" % line)
-        argv = line.split(':')
-        key = argv.pop(0)
-        kspec = Journal.KEYSPECS[key]
-        assert len(argv) == len(kspec), (key, argv)
-        kw = {}
-        for i, (pname, ptype) in enumerate(kspec) :
-            kw[pname] = self.adapt(ptype, argv[i])
-        entry = self.make_entry(key, kw)
-        self.__update2(entry)
-        
-        trace(">> %s" % ', '.join("`%s'" % w for w in argv))
+    # Torn records (see the formats) are ignored and the state's
+    # offset is left where they start, so writers can truncate them.
+    # Invalid records in the middle of the file are reported and
+    # skipped.
+    #
+    def __read (self, buf, fname) :
+        js = self.jstate
+        trace("parsing journal records from offset %d" % js.offset)
+        if js.offset == 0 :
+            js.format = _detect_format(buf)
+            js.offset = len(JOURNAL_FORMATS[js.format].HEADER)
+        # called with the state lock held
+        apply = js.apply
+        offset, nlines = js.offset, js.nlines
+        # the records only make acyclic objects, don't let the cyclic
+        # GC rescan them again and again while they pile up
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for offset, entry, err in JOURNAL_FORMATS[js.format].records(buf, offset) :
+                nlines += 1
+                if err :
+                    error("%s:%d: %s" % (fname, nlines, err))
+                elif entry is not None :
+                    try:
+                        apply(entry)
+                    except Exception:
+                        exception("%s:%d: invalid journal record: %s" %
+                                  (fname, nlines, entry))
+        finally:
+            js.offset, js.nlines = offset, nlines
+            if gc_enabled :
+                gc.enable()
+        if js.offset < len(buf) :
+            warning("%s:%d: ignoring torn journal record" % (fname, js.nlines+1))
 
 
     # __roll:
@@ -418,53 +962,108 @@ class Journal :
             os.close(fd)
         # ok, go
         self.close()
+        _forget_state(self.fname)
         os.rename(self.fname, dest)
+        return dest
 
 
     # record:
     #
     def record (self, key, **kwargs) :
+        self.record_many(((key, kwargs),))
+
+
+    # record_many:
+    #
+    # Record a list of (key, kwargs) with a single write.
+    #
+    def record_many (self, records) :
         assert self.mode in ('w', 'a')
         assert self.isopen()
+        with self.wcond :
+            self.nwriters += 1
+        try:
+            seq = self.__record(records)
+        finally:
+            with self.wcond :
+                self.nwriters -= 1
+                self.wcond.notify_all()
+        self.__commit(seq)
+
+    def __record (self, records) :
+        fmt = JOURNAL_FORMATS[self.jstate.format]
+        entries = []
+        lines = []
+        data = []
+        for key, kwargs in records :
+            codec = Journal.CODECS[key]
+            entry, line = codec.encode(kwargs)
+            entries.append(entry)
+            lines.append(line)
+            data.append(fmt.encode(codec, entry, line))
+        trace("JOURNAL: %s" % '\n  '.join(lines))
+        data = b''.join(data)
+        # write file - a single write() in O_APPEND mode, so records
+        # from different writers are never interleaved
         with self.flock :
-            self.__record(key, **kwargs)
-
-    def __record (self, key, **kwargs) :
-        entry = self.make_entry(key, kwargs)
-        self.__update2(entry)
-        # write file
-        line = [key] + list(Journal.convert(ptype, getattr(entry, pname))
-                            for pname, ptype in Journal.KEYSPECS[key])
-        trace("JOURNAL: %s" % line)
-        # atomic update - [fixme] looks ugly but i don't know a better
-        # way ; maybe the file should be chunked if it becomes too big
-        # ?
-        tmp = self.fname + '.tmp'
-        f = open(tmp, 'wt')
-        # file must exist!
-        f.write(open(self.fname, 'rt').read())
-        f.write(':'.join(line))
-        f.write('\n')
-        f.flush()
-        os.fsync(f.fileno()) # fdatasync ?
-        f.close()
-        os.rename(tmp, self.fname)
+            with self.wcond, self.jstate.lock :
+                # first parse what the other processes wrote
+                size = os.fstat(self.fd).st_size
+                if size > self.jstate.offset :
+                    self.__read_file()
+                for entry in entries :
+                    self.__update2(entry)
+                n = os.write(self.fd, data)
+                assert n == len(data), (n, len(data))
+                if size == self.jstate.offset :
+                    self.jstate.offset += n
+                    self.jstate.nlines += len(entries)
+                else :
+                    # a torn record is in the way, reparse it all
+                    # next time
+                    _forget_state(self.fname)
+                self.wseq += 1
+                return self.wseq
+
+
+    # __commit:
+    #
+    # Wait until record number 'seq' is on disk. The first waiter
+    # becomes the leader: it syncs everything written so far, while
+    # the others wait for it (and for the next sync if their record
+    # came too late).
+    #
+    def __commit (self, seq) :
+        with self.wcond :
+            while self.synced < seq :
+                if not self.syncing :
+                    break
+                self.wcond.wait()
+            else :
+                return
+            self.syncing = True
+            # give the writers which are on their way a chance to
+            # join this sync
+            if self.nwriters > 0 :
+                self.wcond.wait(self.COMMIT_WINDOW)
+            target = self.wseq
+            fd = self.fd
+        try:
+            os.fdatasync(fd)
+        except:
+            with self.wcond :
+                self.syncing = False
+                self.wcond.notify_all()
+            raise
+        with self.wcond :
+            self.syncing = False
+            self.synced = max(self.synced, target)
+            self.wcond.notify_all()
 
 
     def __update2 (self, entry) :
-        with self.tlock :
-            if entry.key == '_OPEN' :
-                if self.curss is not None :
-                    trace("journal: session was not closed: %s" % repr(self.curss[0]))
-                self.curss = [entry]
-                self.state2.append(self.curss)
-            elif entry.key == '_CLOSE' :
-                assert self.curss is not None
-                assert self.curss[0].tool == entry.tool
-                self.curss = None
-            else :
-                assert self.curss is not None
-                self.curss.append(entry)
+        with self.jstate.lock :
+            self.jstate.apply(entry)
 
 
     # [removeme]
@@ -484,10 +1083,4 @@ class Journal :
     # make_entry:
     #
     def make_entry (self, key, kwargs) :
-        #kwargs = copy.deepcopy(kwargs) # [fixme] ?
-        kspec = Journal.KEYSPECS[key]
-        assert len(kspec) == len(kwargs), kwargs
-        ktype = Journal.KEYTYPES[key]
-        for pname, ptype in kspec :
-            self.convert(ptype, kwargs[pname]) # [fixme] just to check validity
-        return ktype(key=key, **kwargs)
+        return Journal.CODECS[key].encode(kwargs)[0]
@@ -10,6 +10,7 @@ from mybackup.base import *
 from mybackup.log import *
 from mybackup import config
 from mybackup import journal
+from mybackup import mbdb
 
 
 # MBAppBase:
@@ -118,6 +119,19 @@ class MBAppBase :
         self.app_run()
 
 
+    # open_db:
+    #
+    # Writer tools get a backup of the DB before their first change
+    # (see DB.backup), the others a read-only connection.
+    #
+    def open_db (self, writer=False) :
+        if not writer :
+            return mbdb.open_db(self.config.dbfile, readonly=True)
+        db = mbdb.open_db(self.config.dbfile)
+        db.backup()
+        return db
+
+
     # roll_journal:
     #
     # [fixme] ?
@@ -131,7 +145,25 @@ class MBAppBase :
         assert ss[0].tool == 'dump', ss
         if len(ss) > 1 :
             assert ss[1].key == 'START', ss
-            j.roll(dirname=self.config.journaldir, sfx='.%s' % ss[1].hrs)
+            dest = j.roll(dirname=self.config.journaldir, sfx='.%s' % ss[1].hrs)
+            self.archive_journal(dest)
         else :
             info("dump never started, deleting journal")
             j.delete()
+
+
+    # archive_journal:
+    #
+    # Import a rolled journal in the DB. A failure is not fatal, the
+    # journal stays in journaldir and 'mbjournal archive' can import
+    # it later.
+    #
+    def archive_journal (self, fname) :
+        trace("archiving journal '%s'" % fname)
+        try:
+            db = mbdb.open_db(self.config.dbfile)
+            db.archive_journal(os.path.basename(fname),
+                               *mbdb.journal_archive_rows(fname))
+        except Exception:
+            error("could not archive journal '%s'" % fname,
+                  exc_info=sys.exc_info())
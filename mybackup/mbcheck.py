@@ -14,6 +14,9 @@ USAGE: mbcheck [OPTIONS] CONFIG
 
 OPTIONS:
 
+  -p, --query-plans
+                   check that no query of the DB scans a whole table
+                   (fails if one does)
   -q, --quiet      be less verbose
   -v, --verbose    be more verbose
   -h, --help       print this message and exit
@@ -32,13 +35,16 @@ class MBCheckApp (mbapp.MBAppBase) :
     #
     def app_run (self) :
         # parse the command line
-        shortopts = 'hqv'
-        longopts = ['help']
+        self.query_plans = False
+        shortopts = 'phqv'
+        longopts = ['query-plans', 'help']
         opts, args = getopt.gnu_getopt(sys.argv[1:], shortopts, longopts)
         for o, a in opts :
             if o in ('-h', '--help') :
                 sys.stdout.write(USAGE)
                 sys.exit(0)
+            elif o in ('-p', '--query-plans') :
+                self.query_plans = True
             elif o in ('-q', '--quiet') :
                 self.quiet()
             elif o in ('-v', '--verbose') :
@@ -64,9 +70,22 @@ class MBCheckApp (mbapp.MBAppBase) :
     #
     def __main_L (self, args) :
         # [FIXME] try to open the db and journal ?
+        if self.query_plans :
+            self.__check_query_plans()
         info("config '%s' seems clean" % self.config.cfgname)
 
 
+    # __check_query_plans:
+    #
+    def __check_query_plans (self) :
+        bad = self.open_db().check_query_plans()
+        for name, step in bad :
+            error("query '%s' does a full scan: %s" % (name, step))
+        if bad :
+            sys.exit(1)
+        info("no query does a full scan")
+
+
 # exec
 if __name__ == '__main__' :
     MBCheckApp.main()
@@ -78,6 +78,8 @@ class MBCleanApp (mbapp.MBAppBase) :
                  self.config.cfgname)
             return
         info("journal found, cleaning up...")
+        # backup the DB before the post-processing changes it
+        self.open_db(writer=True)
         pp = postproc.PostProcess()
         try:
             pp.run(self.config)
@@ -2,13 +2,17 @@
 
 __all__ = [
     'DB',
+    'open_db',
+    'create_db',
+    'journal_archive_rows',
 ]
 
-import sqlite3, collections
+import sqlite3, collections, re, json, contextlib, urllib.parse
 
 from mybackup.base import *
 from mybackup.log import *
 from mybackup.tools import *
+from mybackup.journal import Journal, read_journal_file
 
 
 # DB:
@@ -31,52 +35,242 @@ class DB :
                    ('nfiles',    'int'),
                    ('hashtype', 'text'),
                    ('hashsum', 'text'))),
+
+        # the rolled journals (see archive_journal)
+        ('journal_files', (('jfileid', 'integer primary key autoincrement'),
+                           ('fname', 'text unique'),
+                           ('hrs', 'text'),
+                           ('runid', 'int'),
+                           ('format', 'text'),
+                           ('nrecords', 'int'))),
+
+        ('journal_records', (('jfileid', 'references journal_files(jfileid)'),
+                             ('seq', 'int'),
+                             ('key', 'text'),
+                             ('disk', 'text'),
+                             ('data', 'text'))),
+
+        # how the dumps went (see record_dump_stats), times in seconds
+        ('dump_stats', (('runid', 'references runs(runid)'),
+                        ('disk', 'text'),
+                        ('start_time', 'int'),
+                        ('end_time', 'int'),
+                        ('dumper_cpu', 'real'),
+                        ('pipe_cpu', 'real'),
+                        ('comp_time', 'real'))),
+    )
+
+
+    # __MIGRATIONS:
+    #
+    # The schema changes, in order. The 'user_version' of a DB is the
+    # number of migrations it got, the missing ones are applied when
+    # it is opened. Each one is a description, the tables to create
+    # (from __TABLES) and some SQL. DBs created before the migrations
+    # may already have some of the tables, hence the 'if not exists'.
+    #
+    __MIGRATIONS = (
+        ('initial schema', ('runs', 'dumps'), ()),
+
+        ('journal archive', ('journal_files', 'journal_records'),
+         ('create index if not exists journal_files_hrs on journal_files (hrs)',
+          'create index if not exists journal_records_disk on journal_records (disk, key)',
+          'create index if not exists journal_records_key on journal_records (key)')),
+
+        # (runs.hrs is unique, so it already has an index)
+        ('catalog indexes', (),
+         ('create index if not exists dumps_disk_runid on dumps (disk, runid)',)),
+
+        ('dump stats', ('dump_stats',),
+         ('create unique index if not exists dump_stats_disk_runid on dump_stats (disk, runid)',)),
     )
 
+    # the current schema version
+    SCHEMA_VERSION = len(__MIGRATIONS)
+
+
+    # __SQL:
+    #
+    # The catalog queries, which must never scan a whole table (see
+    # check_query_plans).
+    #
+    __SQL = {
+        'select_run': 'select * from runs where runid == ?',
+        'select_run_hrs': 'select * from runs where hrs == ?',
+        'select_dump': 'select * from dumps where runid == ? and disk == ?',
+        'select_disk_dumps': 'select dumps.*, runs.hrs from dumps join runs using (runid)' +
+                             ' where disk == ? order by runid desc',
+        'select_last_dump': 'select * from dumps where disk == ? order by runid desc limit 1',
+        'select_last_dumps': 'select dumps.*, runs.hrs from json_each(?) as disks' +
+                             ' join dumps on dumpid == (select dumpid from dumps' +
+                             ' where disk == disks.value order by runid desc limit 1)' +
+                             ' join runs using (runid)',
+        'select_cycle': 'select * from dumps where disk == ? order by runid desc',
+        'select_disks': 'select disk from dumps group by disk',
+        'select_archived_journal': 'select jfileid from journal_files where fname == ?',
+        'select_dump_stats': 'select * from dump_stats where runid == ? and disk == ?',
+    }
+
+
+    # __PLAN_EXCEPTIONS:
+    #
+    # The plan steps other than SEARCH that check_query_plans()
+    # accepts, by query.
+    #
+    __PLAN_EXCEPTIONS = {
+        # the disk names must be read from the index
+        'select_disks': (re.compile(r'SCAN dumps USING COVERING INDEX dumps_disk_runid$'),),
+        # one search per disk name given
+        'select_last_dumps': (re.compile(r'SCAN disks VIRTUAL TABLE\b'),
+                              re.compile(r'CORRELATED SCALAR SUBQUERY\b')),
+    }
+
+
+    # number of pages copied per step of backup()
+    BACKUP_PAGES = 256
+
 
+    # column names -> namedtuple type, shared by all the DBs
     __tpcache = {}
 
-    # [fixme] how to adapt DumpState
     sqlite3.register_converter('dumpstate', DumpState.convert)
 
 
-    # __row:
+    # __rowtype:
     #
-    def __row (self, cur, row) :
-        key = tuple(d[0] for d in cur.description)
-        tp = self.__tpcache.get(key)
+    # The namedtuple type of the rows returned by 'sql', looked up
+    # once per statement instead of once per row.
+    #
+    def __rowtype (self, sql, description) :
+        tp = self.rowtypes.get(sql)
         if tp is None :
-            tp = self.__tpcache[key] = collections.namedtuple('Row%d' % len(self.__tpcache), key)
-        return tp(*row)
+            key = tuple(d[0] for d in description)
+            tp = DB.__tpcache.get(key)
+            if tp is None :
+                tp = DB.__tpcache[key] = collections.namedtuple('Row%d' % len(DB.__tpcache), key)
+            self.rowtypes[sql] = tp
+        return tp
 
     
     # __init__:
     #
-    def __init__ (self, fname) :
+    # Use open_db() instead, which shares the connection.
+    #
+    # A 'readonly' DB can't change the file at all. If the file does
+    # not exist or its schema is not current, it is first opened for
+    # writing to create or upgrade it. 'version' stops the upgrade at
+    # an older schema (see create_db).
+    #
+    def __init__ (self, fname, readonly=False, version=None) :
         self.fname = fname
-        if os.path.exists(fname) :
-            # [FIXME] should only be done by writer tools
-            backup_file(fname)
-        else :
+        self.readonly = readonly
+        self.backed_up = False
+        self.lock = threading.RLock()
+        self.tdepth = 0
+        self.rowtypes = {}
+        if readonly :
+            self.con = None
+            if os.path.exists(fname) :
+                self.__connect()
+                if self.schema_version() >= DB.SCHEMA_VERSION :
+                    return
+                self.close()
+            DB(fname).close()
+            self.__connect()
+            return
+        if not os.path.exists(fname) :
             open(fname, 'wt').close()
-        self.con = sqlite3.connect(self.fname, detect_types=sqlite3.PARSE_DECLTYPES)
-        self.con.row_factory = self.__row
-        self._init()
+        self.__connect()
+        # readers don't block the writer and commits don't need a
+        # full sync in WAL mode
+        self._execute('pragma journal_mode=wal')
+        self._execute('pragma synchronous=normal')
+        self._init(DB.SCHEMA_VERSION if version is None else version)
+
+
+    # __connect:
+    #
+    def __connect (self) :
+        if self.readonly :
+            uri = 'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(self.fname))
+            self.con = sqlite3.connect(uri, uri=True, detect_types=sqlite3.PARSE_DECLTYPES,
+                                       check_same_thread=False)
+            self.con.execute('pragma query_only=1')
+        else :
+            self.con = sqlite3.connect(self.fname, detect_types=sqlite3.PARSE_DECLTYPES,
+                                       check_same_thread=False)
+
+
+    # close:
+    #
+    def close (self) :
+        with self.lock :
+            if self.con is not None :
+                self.con.close()
+                self.con = None
 
 
     # _init:
     #
-    def _init (self) :
-        sel = self._execute('select * from sqlite_master')
-        if sel :
-            trace("[todo] update db")
+    # Apply the missing migrations up to version 'target', all in one
+    # transaction.
+    #
+    def _init (self, target) :
+        if self.schema_version() >= target :
             return
-        for tname, tcols in DB.__TABLES :
-            sql = 'create table %s (' % tname
-            sql += ', '.join('%s %s' % c for c in tcols)
-            sql += ')'
-            self._execute(sql)
-        self._commit()
+        # 'immediate' so that two processes don't migrate at the same
+        # time
+        with self.transaction(immediate=True) :
+            version = self.schema_version()
+            tables = dict(DB.__TABLES)
+            # (new DBs are not worth a message)
+            log = info if version > 0 else trace
+            for n in range(version, target) :
+                descr, tnames, sqls = DB.__MIGRATIONS[n]
+                log("%s: upgrading schema to version %d: %s" % (self.fname, n + 1, descr))
+                for tname in tnames :
+                    sql = 'create table if not exists %s (' % tname
+                    sql += ', '.join('%s %s' % c for c in tables[tname])
+                    sql += ')'
+                    self._execute(sql)
+                for sql in sqls :
+                    self._execute(sql)
+            self._execute('pragma user_version = %d' % target)
+        # the columns of the tables may have changed
+        self.rowtypes.clear()
+
+
+    # schema_version:
+    #
+    # The number of migrations applied to the DB.
+    #
+    def schema_version (self) :
+        return self._execute('pragma user_version')[0][0]
+
+
+    # check_query_plans:
+    #
+    # Return the (query name, plan step) of the catalog queries (or
+    # of 'queries', name -> sql) which would not only do index
+    # searches. Every step of their plans must be a SEARCH, or be
+    # listed in __PLAN_EXCEPTIONS.
+    #
+    def check_query_plans (self, queries=None) :
+        bad = []
+        if queries is None :
+            queries = DB.__SQL
+        for name, sql in sorted(queries.items()) :
+            plan = self._execute('explain query plan ' + sql,
+                                 (None,) * sql.count('?'))
+            allowed = DB.__PLAN_EXCEPTIONS.get(name, ())
+            for step in plan :
+                trace("%s: %s" % (name, step.detail))
+                if step.detail.startswith('SEARCH ') :
+                    continue
+                if any(r.match(step.detail) for r in allowed) :
+                    continue
+                bad.append((name, step.detail))
+        return bad
 
 
     # __repr__:
@@ -102,17 +296,99 @@ class DB :
         trace("DBDUMP:\n%s" % ''.join(lines), depth=depth+1)
 
 
+    # backup:
+    #
+    # Copy the DB to 'fname~' with the online backup API, a few pages
+    # at a time. The copy reads from its own read-only connection, so
+    # the DB lock is not held: the other threads (and processes, in
+    # WAL mode) can use the DB between the steps. Writer tools call it
+    # before their first change, it only runs once per process.
+    #
+    def backup (self) :
+        if self.backed_up :
+            return
+        bakfile = self.fname + '~'
+        tmpfile = bakfile + 'tmp~'
+        if os.path.exists(tmpfile) :
+            os.unlink(tmpfile)
+        start = time.monotonic()
+        nsteps = 0
+        def progress (status, remaining, total) :
+            nonlocal nsteps
+            nsteps += 1
+        uri = 'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(self.fname))
+        source = sqlite3.connect(uri, uri=True)
+        try:
+            dest = sqlite3.connect(tmpfile)
+            try:
+                source.backup(dest, pages=DB.BACKUP_PAGES, progress=progress)
+            finally:
+                dest.close()
+        finally:
+            source.close()
+        os.rename(tmpfile, bakfile)
+        self.backed_up = True
+        trace("DB backup done in %.3fs (%d steps): '%s'" %
+              (time.monotonic() - start, nsteps, bakfile))
+
+
+    # transaction:
+    #
+    # A context manager grouping the statements executed in it (by
+    # this thread, the others wait) in a single transaction,
+    # committed at the end or rolled back on error. Transactions may
+    # be nested, only the outer one counts.
+    #
+    @contextlib.contextmanager
+    def transaction (self, immediate=False) :
+        with self.lock :
+            if self.tdepth == 0 :
+                self.con.execute('begin immediate' if immediate else 'begin')
+            self.tdepth += 1
+            try:
+                yield self
+            except:
+                self.tdepth -= 1
+                if self.tdepth == 0 :
+                    self.con.rollback()
+                raise
+            self.tdepth -= 1
+            if self.tdepth == 0 :
+                self._commit()
+
+
     # _execute:
     #
-    def _execute (self, sql, args=(), commit=True) :
-        cur = self.con.cursor()
-        #trace("SQL: %s" % sql)
-        cur.execute(sql, args)
-        r = list(cur.fetchall())
-        if commit :
-            self._commit()
-        cur.close()
-        return r
+    # Outside of a transaction(), the changes are committed at once.
+    #
+    def _execute (self, sql, args=()) :
+        with self.lock :
+            cur = self.con.cursor()
+            #trace("SQL: %s" % sql)
+            cur.execute(sql, args)
+            r = cur.fetchall()
+            if cur.description is not None :
+                r = list(map(self.__rowtype(sql, cur.description)._make, r))
+            cur.close()
+            if self.tdepth == 0 and self.con.in_transaction :
+                self._commit()
+            return r
+
+
+    # _scan:
+    #
+    # Bulk mode for the selects which may return a lot of rows: they
+    # are plain sqlite3.Row objects, made by sqlite itself. They are
+    # indexed by column name or position but have no attributes.
+    #
+    def _scan (self, sql, args=()) :
+        with self.lock :
+            cur = self.con.cursor()
+            cur.row_factory = sqlite3.Row
+            cur.execute(sql, args)
+            r = cur.fetchall()
+            cur.close()
+            return r
 
 
     # _commit:
@@ -124,9 +400,7 @@ class DB :
     # record_run:
     #
     def record_run (self, hrs) :
-        self._execute('insert into runs (hrs) values (?)',
-                      (hrs,), commit=True)
-        sel = self._execute('select * from runs where hrs == ?', (hrs,))
+        sel = self._execute('insert into runs (hrs) values (?) returning *', (hrs,))
         assert len(sel) == 1
         trace("run recorded: %d (%s)" % (sel[0].runid, sel[0].hrs))
         return sel[0].runid
@@ -135,7 +409,7 @@ class DB :
     # select_run:
     #
     def select_run (self, runid) :
-        sel = self._execute('select * from runs where runid == ?', (runid,))
+        sel = self._execute(DB.__SQL['select_run'], (runid,))
         return sel[0] if sel else None
 
 
@@ -145,39 +419,254 @@ class DB :
         # [FIXME] must be carefull with 'state' because i didn't find
         # a way to automatically 'adapt' it
         state = DumpState.tostr(state)
-        self._execute('insert into dumps ' +
-                      '(disk, runid, prevrun, state, fname, raw_size, comp_size, nfiles, hashtype, hashsum) ' +
-                      'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                      (disk, runid, prevrun, state, fname, raw_size, comp_size, nfiles, hashtype, hashsum))
-        rec = self.select_dump(runid=runid, disk=disk)
-        assert rec is not None, (disk, runid)
+        sel = self._execute('insert into dumps ' +
+                            '(disk, runid, prevrun, state, fname, raw_size, comp_size, nfiles, hashtype, hashsum) ' +
+                            'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) returning *',
+                            (disk, runid, prevrun, state, fname, raw_size, comp_size, nfiles, hashtype, hashsum))
+        assert len(sel) == 1, (disk, runid)
         trace("dump recorded: %s" % repr(disk))
-        return rec
+        return sel[0]
 
 
     # select_dump:
     #
     def select_dump (self, runid, disk) :
-        sel = self._execute('select * from dumps where runid == ? and disk == ?',
-                            (runid, disk))
+        sel = self._execute(DB.__SQL['select_dump'], (runid, disk))
         assert len(sel) <= 1
         return sel[0] if sel else None
 
 
+    # select_dumps:
+    #
+    # All the dumps (of 'disk' if given) with their run's hrs, the
+    # most recent first, as sqlite3.Row objects (see _scan).
+    #
+    def select_dumps (self, disk=None) :
+        if disk is not None :
+            return self._scan(DB.__SQL['select_disk_dumps'], (disk,))
+        # all of them, this one has to scan
+        return self._scan('select dumps.*, runs.hrs from dumps join runs using (runid)' +
+                             ' order by runid desc')
+
+
     # select_last_dump:
     #
     def select_last_dump (self, disk) :
-        sel = self._execute('select * from dumps where disk == ?' +
-                            ' order by runid desc', (disk,))
+        sel = self._execute(DB.__SQL['select_last_dump'], (disk,))
         return sel[0] if sel else None
 
 
+    # select_last_dumps:
+    #
+    # The last dump of each of 'disks' with its run's hrs, as a dict
+    # indexed by disk name, in a single query. Disks without a dump
+    # are not in the dict.
+    #
+    def select_last_dumps (self, disks) :
+        sel = self._execute(DB.__SQL['select_last_dumps'], (json.dumps(list(disks)),))
+        return dict((r.disk, r) for r in sel)
+
+
+    # select_disks:
+    #
+    # The names of the disks which have dumps.
+    #
+    def select_disks (self) :
+        return [r.disk for r in self._execute(DB.__SQL['select_disks'])]
+
+
     # get_current_cycle:
     #
     def get_current_cycle (self, disk) :
-        sel = self._execute('select * from dumps ' +
-                            'where disk == ? ' +
-                            'order by runid desc',
-                            (disk,))
+        sel = self._execute(DB.__SQL['select_cycle'], (disk,))
         trace("get_cycle(%s) -> %s" % (disk, sel))
         return sel
+
+
+    # record_dump_stats:
+    #
+    # Store the performance figures of a dump: when it started and
+    # finished (unix time in whole seconds, as in the journal), the
+    # CPU time of the dumper process and of the pipes, and the time
+    # spent compressing.
+    #
+    def record_dump_stats (self, runid, disk, start_time, end_time, dumper_cpu, pipe_cpu, comp_time) :
+        sel = self._execute('insert or replace into dump_stats ' +
+                            '(runid, disk, start_time, end_time, dumper_cpu, pipe_cpu, comp_time) ' +
+                            'values (?, ?, ?, ?, ?, ?, ?) returning *',
+                            (runid, disk, start_time, end_time, dumper_cpu, pipe_cpu, comp_time))
+        assert len(sel) == 1, (disk, runid)
+        trace("dump stats recorded: %s" % repr(disk))
+        return sel[0]
+
+
+    # select_dump_stats:
+    #
+    def select_dump_stats (self, runid, disk) :
+        sel = self._execute(DB.__SQL['select_dump_stats'], (runid, disk))
+        return sel[0] if sel else None
+
+
+    # select_dump_trends:
+    #
+    # The successful dumps which have stats, by disk then oldest
+    # first, with their duration, throughput ('rate', raw bytes per
+    # second) and compression ratio, and the rolling averages of
+    # these over the last 'window' dumps of the disk. 'last' limits
+    # the result to the last dumps of each disk (0 for all).
+    #
+    def select_dump_trends (self, disks=(), window=5, last=0) :
+        assert window >= 1, window
+        where, args = ["dumps.state == 'ok'"], []
+        if disks :
+            where.append('disk in (%s)' % ', '.join('?' * len(disks)))
+            args.extend(disks)
+        args.append(window - 1)
+        sql = 'select * from (' + \
+          'select disk, runid, hrs, start_time, end_time, duration,' + \
+          ' raw_size, comp_size, dumper_cpu, pipe_cpu, comp_time,' + \
+          ' raw_size * 1.0 / nullif(duration, 0) as rate,' + \
+          ' comp_size * 1.0 / nullif(raw_size, 0) as ratio,' + \
+          ' avg(duration) over win as avg_duration,' + \
+          ' sum(raw_size) over win * 1.0 / nullif(sum(duration) over win, 0) as avg_rate,' + \
+          ' sum(comp_size) over win * 1.0 / nullif(sum(raw_size) over win, 0) as avg_ratio,' + \
+          ' row_number() over (partition by disk order by runid desc) as age' + \
+          ' from (select dump_stats.*, end_time - start_time as duration,' + \
+          ' raw_size, comp_size, hrs' + \
+          ' from dump_stats join dumps using (runid, disk) join runs using (runid)' + \
+          ' where ' + ' and '.join(where) + ')' + \
+          ' window win as (partition by disk order by runid' + \
+          ' rows between ? preceding and current row))'
+        if last > 0 :
+            sql += ' where age <= ?'
+            args.append(last)
+        sql += ' order by disk, runid'
+        return self._execute(sql, args)
+
+
+    # archive_journal:
+    #
+    # Store the records of a rolled journal, as returned by
+    # journal_archive_rows(). 'fname' is the base name of the file,
+    # returns False if it was already archived.
+    #
+    def archive_journal (self, fname, hrs, runid, fmt, rows) :
+        with self.transaction() :
+            sel = self._execute(DB.__SQL['select_archived_journal'], (fname,))
+            if sel :
+                trace("journal already archived: '%s'" % fname)
+                return False
+            cur = self.con.cursor()
+            cur.execute('insert into journal_files ' +
+                        '(fname, hrs, runid, format, nrecords) ' +
+                        'values (?, ?, ?, ?, ?)',
+                        (fname, hrs, runid, fmt, len(rows)))
+            jfileid = cur.lastrowid
+            cur.executemany('insert into journal_records ' +
+                            '(jfileid, seq, key, disk, data) ' +
+                            'values (?, ?, ?, ?, ?)',
+                            ((jfileid,) + r for r in rows))
+            cur.close()
+        trace("journal archived: '%s' (%d records)" % (fname, len(rows)))
+        return True
+
+
+    # select_archived_journals:
+    #
+    def select_archived_journals (self) :
+        sel = self._scan('select fname from journal_files')
+        return set(r['fname'] for r in sel)
+
+
+    # select_journal_records:
+    #
+    # The archived records matching all the given filters, oldest
+    # first, as sqlite3.Row objects (see _scan). 'since' is an hrs,
+    # 'match' a substring of the data.
+    #
+    def select_journal_records (self, disks=(), keys=(), since=None, match=None) :
+        sql = 'select journal_files.hrs, journal_files.runid, ' + \
+          'key, disk, data from journal_records join journal_files using (jfileid)'
+        where, args = [], []
+        if disks :
+            where.append('disk in (%s)' % ', '.join('?' * len(disks)))
+            args.extend(disks)
+        if keys :
+            where.append('key in (%s)' % ', '.join('?' * len(keys)))
+            args.extend(keys)
+        if since is not None :
+            where.append('journal_files.hrs >= ?')
+            args.append(since)
+        if match is not None :
+            where.append("instr(data, ?) > 0")
+            args.append(match)
+        if where :
+            sql += ' where ' + ' and '.join(where)
+        sql += ' order by journal_files.hrs, seq'
+        return self._scan(sql, args)
+
+
+# (file path, readonly) -> DB
+_DBS = {}
+_DBS_LOCK = threading.Lock()
+
+
+# open_db:
+#
+# Return the DB of file 'fname'. It is opened once per process (and
+# mode) and shared by all its users.
+#
+def open_db (fname, readonly=False) :
+    key = (os.path.abspath(fname), readonly)
+    with _DBS_LOCK :
+        db = _DBS.get(key)
+        if db is None :
+            db = _DBS[key] = DB(fname, readonly)
+        return db
+
+
+# create_db:
+#
+# Create the DB file 'fname' with the schema of 'version', to check
+# the upgrades from it. Version 0 is a DB made before the migrations,
+# which already has the tables of the first one.
+#
+def create_db (fname, version) :
+    assert not os.path.exists(fname), fname
+    DB(fname, version=max(version, 1)).close()
+    if version == 0 :
+        con = sqlite3.connect(fname)
+        con.execute('pragma user_version = 0')
+        con.close()
+
+
+# RE_ROLLED_JOURNAL:
+#
+RE_ROLLED_JOURNAL = re.compile(r'\.(?P<hrs>[0-9]{14})\.[^.]+$')
+
+
+# journal_archive_rows:
+#
+# Read a rolled journal and return (hrs, runid, format, rows), the
+# rows being the (seq, key, disk, data) of its records. Only plain
+# values are returned so it can run in a worker process. The disk of
+# the hook records is taken from their source.
+#
+def journal_archive_rows (fname) :
+    fmt, entries = read_journal_file(fname)
+    m = RE_ROLLED_JOURNAL.search(fname)
+    hrs = m.group('hrs') if m else None
+    runid = None
+    rows = []
+    for seq, entry in enumerate(entries) :
+        key = entry.key
+        if key == 'START' and runid is None :
+            hrs, runid = entry.hrs, entry.runid
+        disk = getattr(entry, 'disk', None)
+        if disk is None :
+            source = getattr(entry, 'source', '')
+            if source.startswith('hook.') :
+                disk = source.split('.')[1]
+        line = Journal.CODECS[key].format_line(entry)
+        rows.append((seq, key, disk, line[len(key)+1:]))
+    return hrs, runid, fmt, rows
@@ -12,6 +12,9 @@ from mybackup.tools import *
 from mybackup import asciitable
 from mybackup.config import Config
 from mybackup.journal import Journal
+from mybackup.tarindex import TarIndexer
+from mybackup.catalog import CatalogWriter, catalog_fname
+from mybackup.compress import seekindex_fname
 from mybackup import mbdb
 from mybackup import postproc
 from mybackup import report
@@ -40,7 +43,11 @@ OPTIONS:
 
 # DumpSched:
 #
-DumpSched = attrdict('DumpSched', ())
+DumpSched = slotrecord('DumpSched', ('disk', 'cfgdisk',
+                                     ('state', None),
+                                     ('prevrun', None),
+                                     ('group', None),
+                                     ('size', None)))
 
 
 # DumpEstimate:
@@ -50,31 +57,102 @@ DumpEstimate = collections.namedtuple(
     ('prev', 'raw', 'comp', 'est'))
 
 
-# Index:
+# DumpPool:
 #
-class Index :
+# Run the scheduled dumps on a pool of worker threads, at most
+# 'nworkers' of them at the same time and at most one per device
+# group. Dumps are started in the order of 'sched', skipping those
+# whose group is busy. Exceptions raised by the handler are
+# collected so that one failed dump does not stop the others.
+#
+class DumpPool :
 
 
     # __init__:
     #
-    def __init__ (self, fname) :
-        self.fname = fname
-        self.f = open(self.fname, 'wt')
-        self.count = 0
-
-
-    # __call__:
+    def __init__ (self, nworkers, handler) :
+        assert nworkers >= 1, nworkers
+        self.nworkers = nworkers
+        self.handler = handler
+        self.cond = threading.Condition()
+        self.queue = []
+        self.busy = set()
+        self.failed = []
+        self.workers = []
+
+
+    # run:
     #
-    def __call__ (self, line) :
-        #trace("INDEX: %s" % line.rstrip())
-        self.f.write(line)
-        self.count += 1
-
-
-    # close:
+    # Process all the dumps in 'sched' and wait until they are
+    # done. Returns a list of (dsched, exc_info) for the failed ones.
+    #
+    def run (self, sched) :
+        self.queue = list(sched)
+        self.busy = set()
+        self.failed = []
+        nthreads = min(self.nworkers, len(self.queue),
+                       len(set(d.group for d in self.queue)))
+        trace("starting %d dump worker(s) for %d dump(s)" %
+              (nthreads, len(self.queue)))
+        self.workers = [threading.Thread(target=self.__worker,
+                                         name='dump-worker[%d]' % n)
+                        for n in range(nthreads)]
+        for w in self.workers :
+            w.start()
+        for w in self.workers :
+            w.join()
+        return self.failed
+
+
+    # shutdown:
+    #
+    # Drop the dumps which are not started yet and wait for the
+    # running ones. Needed when run() was interrupted.
+    #
+    def shutdown (self) :
+        with self.cond :
+            if self.queue :
+                trace("dropping %d pending dump(s)" % len(self.queue))
+            self.queue = []
+            self.cond.notify_all()
+        for w in self.workers :
+            w.join()
+        self.workers = []
+
+
+    # __next:
     #
-    def close (self) :
-        self.f.close()
+    # Pop the next dump whose group is free, waiting if needed.
+    # Returns None when the queue is empty.
+    #
+    def __next (self) :
+        with self.cond :
+            while self.queue :
+                for n, dsched in enumerate(self.queue) :
+                    if dsched.group not in self.busy :
+                        del self.queue[n]
+                        self.busy.add(dsched.group)
+                        return dsched
+                self.cond.wait()
+            return None
+
+
+    # __worker:
+    #
+    def __worker (self) :
+        while True :
+            dsched = self.__next()
+            if dsched is None :
+                return
+            try:
+                self.handler(dsched)
+            except Exception:
+                with self.cond :
+                    self.failed.append((dsched, sys.exc_info()))
+            finally:
+                with self.cond :
+                    self.busy.discard(dsched.group)
+                    self.cond.notify_all()
 
 
 # MBDumpApp:
@@ -139,16 +217,16 @@ class MBDumpApp (mbapp.MBAppBase) :
     #
     def __main_L (self, args) :
         # open the DB
-        self.db = mbdb.DB(self.config.dbfile)
+        self.db = self.open_db(writer=True)
         # [fixme] select disks
-        sched = self.__select_disks(args)
+        sched, last_dumps = self.__select_disks(args)
         if not sched :
             info("no disk selected, bye")
             return
         info("selected %d disks: %s" %
              (len(sched), ', '.join(d.disk for d in sched)))
         # go
-        self.__process(sched)
+        self.__process(sched, last_dumps)
         # cleanup
         pp = postproc.PostProcess()
         pp.run(self.config)
@@ -166,6 +244,9 @@ class MBDumpApp (mbapp.MBAppBase) :
 
     # __select_disks:
     #
+    # Returns the dumps to schedule and the last dump of each disk
+    # (which is also needed to order them, see __order_dumps).
+    #
     def __select_disks (self, args) :
         trace("selecting disks (%d args: %s force=%s)" %
               (len(args), args, self.config.force))
@@ -174,16 +255,17 @@ class MBDumpApp (mbapp.MBAppBase) :
         else :
             disklist = list(self.config.disks.values())
         sched = []
+        last_dumps = self.db.select_last_dumps(d.name for d in disklist)
         for disk in disklist :
             if self.config.force :
                 info("%s: force flag set, selected" % disk.name)
             else :
-                dump = self.db.select_last_dump(disk.name)
+                dump = last_dumps.get(disk.name)
                 trace("%s: %s" % (disk.name, dump))
                 if dump is None :
                     info("%s: no last dump found, selected" % disk)
                 else :
-                    hrs = self.db.select_run(dump.runid).hrs
+                    hrs = dump.hrs
                     # [TODO]
                     if hrs[:8] > self.config.start_hrs[:8] :
                         error("%s: last dump is in the future!!" % disk.name)
@@ -203,19 +285,23 @@ class MBDumpApp (mbapp.MBAppBase) :
                         info("%s: up to date, skipped" % disk.name)
                         continue
             sched.append(DumpSched(disk=disk.name, cfgdisk=disk))
-        return sched
+        return sched, last_dumps
 
 
     # __process:
     #
-    def __process (self, sched) :
+    def __process (self, sched, last_dumps) :
         # record the run now so we get a runid
         self.runid = self.db.record_run(self.config.start_hrs)
+        # the strange lines this run can still record one by one,
+        # shared by all its parsers
+        self.budget = StrangeBudget(self.config.strange_limit)
         # open the journal
         try:
             self.journal = Journal(self.config.journalfile, 'w',
                                    tool_name='dump', # [fixme]
-                                   lockfile=self.config.journallock)
+                                   lockfile=self.config.journallock,
+                                   fmt=self.config.journal_format)
         except FileExistsError:
             error("could not open journal file: '%s'" % self.config.journalfile)
             error("this probably means that an earlier run failed, please run \`mbclean %s'" %
@@ -235,11 +321,22 @@ class MBDumpApp (mbapp.MBAppBase) :
         for dsched in sched :
             self.__schedule_dump(dsched)
         # run
-        for dsched in sched :
-            self.__process_dump(dsched)
-        # close the journal
-        self.journal.record('END', hrs=stamp2hrs(int(time.time())))
-        self.journal.close()
+        self.__order_dumps(sched, last_dumps)
+        pool = DumpPool(self.config.max_parallel_dumps, self.__process_dump)
+        try:
+            failed = pool.run(sched)
+            for dsched, exc_info in failed :
+                error("%s: dump failed: %s" % (dsched.disk, exc_name(exc_info[1])),
+                      exc_info=exc_info)
+            if failed :
+                # no END record: the run is reported as unfinished
+                # and mbclean will fix the dumps
+                raise failed[0][1][1]
+            self.journal.record('END', hrs=stamp2hrs(int(time.time())))
+        finally:
+            # close the journal
+            pool.shutdown()
+            self.journal.close()
 
 
     # trigger_hooks:
@@ -249,7 +346,7 @@ class MBDumpApp (mbapp.MBAppBase) :
         aborted = []
         for dump in sched :
             try:
-                dump.cfgdisk.run_hooks(trigger, self.journal)
+                dump.cfgdisk.run_hooks(trigger, self.journal, self.budget)
             except Exception:
                 error("%s: %s hook(s) failed" % (dump.disk, trigger))
                 self.abort_dump(sched, dump)
@@ -296,6 +393,25 @@ class MBDumpApp (mbapp.MBAppBase) :
         self.journal.record('SCHEDULE', disk=dsched.disk, prevrun=dsched.prevrun)
 
 
+    # __order_dumps:
+    #
+    # Set the device group of each dump and sort them largest first,
+    # using the raw size of the last recorded dump (from the rows
+    # selected by __select_disks), so that the longest ones don't end
+    # up running alone at the end of the run.
+    # Disks without a previous dump come first, as they will most
+    # probably get a full dump.
+    #
+    def __order_dumps (self, sched, last_dumps) :
+        for dsched in sched :
+            last = last_dumps.get(dsched.disk)
+            dsched.update(group=dsched.cfgdisk.get_device_group(),
+                          size=(-1 if last is None else last.raw_size))
+            trace("%s: group=%s, last size=%s" %
+                  (dsched.disk, dsched.group, human_size(dsched.size)))
+        sched.sort(key=lambda d: (d.size < 0, d.size), reverse=True)
+
+
     # __estim_dump:
     #
     def __estim_dump (self, dsched, prev) :
@@ -320,81 +436,124 @@ class MBDumpApp (mbapp.MBAppBase) :
         trace("dumper: %s" % dumper)
         # looks like we're ready
         self.journal.record('DUMP-START', disk=dsched.disk, fname=destbase+destext)
+        start_time = time.time()
         procs = []
         pipes = []
+        state = DumpState.OK
+        stopped = False
+        fdest = compressor = index = catalog = p_dump = None
+        # all the pipes of this dump are driven by the same loop
+        loop = PipeLoop('dump:%s' % dsched.disk)
         # [fixme] strange parsers
-        outparser = StrangeParser('dumptool', self.journal, ())
-        # open dest file and index
-        trace("temp dump file: '%s'" % destfull)
-        fdest = open(destfull, 'wb')
-        index = Index('/dev/null')
-        # [fixme] filters
-        trace("%s: starting the filters" % cdisk.name)
-        filters = [cmdexec(['gzip'], stdin=CMDPIPE, stdout=CMDPIPE, stderr=CMDPIPE)]
-        pipes.append(PipeThread('zip-err', filters[0].stderr, (), line_handler=outparser))
-        # start the dumper
-        trace("%s: starting the dumper" % cdisk.name)
-        proc_dump = dumper.start(dsched.cfgdisk.path)
-        trace("%s: dumper running with pid %d" % (cdisk.name, proc_dump.pid))
-        procs.append(proc_dump)
-        p_dump = PipeThread('dumper', proc_dump.stdout, ())
-        pipes.append(p_dump)
-        pipes.append(PipeThread('dump-err', proc_dump.stderr, (), line_handler=outparser))
-        # start the index
-        trace("%s: starting the index" % cdisk.name)
-        proc_index = dumper.start_index()
-        trace("%s: index running with pid %d" % (cdisk.name, proc_index.pid))
-        procs.append(proc_index)
-        p_dump.plug_output(proc_index.stdin)
-        p_index = PipeThread('index', proc_index.stdout, (), line_handler=index)
-        pipes.append(p_index)
-        # plug the filters
-        data_plug = p_dump
-        for n, filt in enumerate(filters) :
-            data_plug.plug_output(filt.stdin)
-            data_plug = PipeThread('filter[%d]' % n, filt.stdout, ())
-            procs.append(filt)
-            pipes.append(data_plug)
-        # plug output
-        data_plug.plug_output(fdest)
-        data_plug.set_hashtype('sha1') # [FIXME]
-        # start all pipes
-        for p in pipes :
-            p.start()
-        # then wait...
-        trace("%s: waiting for %d pipes..." % (cdisk.name, len(pipes)))
-        for p in pipes :
-            p.join()
-            #trace("%s: OK (%d bytes)" % (p.name, p.data_size))
+        outparser = StrangeParser('dumptool', self.journal, (),
+                                  budget=self.budget)
+        # if anything fails, the dump is stopped and recorded as
+        # failed ; the parser is closed anyway, so its pending records
+        # and summaries still reach the journal
+        try:
+            # open dest file and index
+            trace("temp dump file: '%s'" % destfull)
+            fdest = open(destfull, 'wb')
+            catalog = CatalogWriter(catalog_fname(destfull))
+            index = TarIndexer(handler=catalog)
+            # the compressor runs in the dumper's pipe
+            compressor = cdisk.get_compressor(fdest, hashtype='sha1') # [FIXME]
+            # start the dumper
+            trace("%s: starting the dumper" % cdisk.name)
+            proc_dump = dumper.start(dsched.cfgdisk.path)
+            trace("%s: dumper running with pid %d" % (cdisk.name, proc_dump.pid))
+            procs.append(proc_dump)
+            p_dump = PipeThread('dumper', proc_dump.stdout, (), loop=loop,
+                                bufsize=(1 << 17), nbufs=1)
+            pipes.append(p_dump)
+            pipes.append(PipeThread('dump-err', proc_dump.stderr, (),
+                                    line_handler=outparser, loop=loop))
+            # plug the index and the output
+            p_dump.plug_output(index)
+            p_dump.plug_output(compressor)
+            # start all pipes
+            for p in pipes :
+                p.start()
+            # then wait...
+            trace("%s: waiting for %d pipes..." % (cdisk.name, len(pipes)))
+            for p in pipes :
+                p.join()
+                trace("%s: pipe %s: %s" % (cdisk.name, p.name, p.stats))
+        except Exception as exc:
+            error("%s: dump failed: %s" % (cdisk.name, exc_name(exc)),
+                  exc_info=sys.exc_info())
+            state = DumpState.FAILED
+            stopped = True
+            self.__stop_dump(cdisk, procs, pipes, compressor, fdest)
+        finally:
+            outparser.close()
         # wait processes
         trace("%s: waiting for %d processes..." % (cdisk.name, len(procs)))
-        state = DumpState.OK
+        dumper_cpu = 0.0
         for p in procs :
             #trace("wait proc: %s" % p)
-            r = p.wait()
-            trace("%s: process %d terminated: %d" % (cdisk.name, p.pid, r))
+            r, cpu = cmdwait(p)
+            dumper_cpu += cpu
+            trace("%s: process %d terminated: %d (cpu %.3fs)" % (cdisk.name, p.pid, r, cpu))
             if r != 0 :
                 error("%s: process %d failed: %d" % (cdisk.name, p.pid, r))
                 state = DumpState.FAILED
-        # close files
-        # [fixme] datasync
-        trace("%s: closing dump file" % cdisk.name)
-        fdest.close()
-        index.close()
+        if not stopped :
+            # close files
+            # [fixme] datasync
+            trace("%s: closing dump file" % cdisk.name)
+            compressor.close()
+            if index.error :
+                warning("%s: the dump index is incomplete: %s" % (cdisk.name, index.error))
+            trace("%s: writing catalog (%d entries)" % (cdisk.name, index.count))
+            catalog.close()
+            if compressor.checkpoint :
+                trace("%s: writing seek index (%d points)" %
+                      (cdisk.name, len(compressor.checkpoints)))
+                compressor.write_seekindex(seekindex_fname(destfull))
         # collect datas about the dump
-        raw_size = p_dump.data_size
-        comp_size = data_plug.data_size
-        nfiles = index.count
+        raw_size = 0 if p_dump is None else p_dump.data_size
+        comp_size = 0 if compressor is None else compressor.data_size
+        nfiles = 0 if index is None else index.count
         hashtype = 'sha1' # [FIXME]
-        hashsum = data_plug.hashsum
+        hashsum = '' if compressor is None else compressor.hashsum
+        end_time = time.time()
         # all done
         self.journal.record('DUMP-FINISHED',
                             disk=dsched.disk, state=DumpState.tostr(state),
                             raw_size=raw_size, comp_size=comp_size,
-                            nfiles=nfiles, hashtype=hashtype, hashsum=hashsum)
-        info("%s: dump finished: %s (%s/%s, %d files)" %
+                            nfiles=nfiles, hashtype=hashtype, hashsum=hashsum,
+                            start_time=int(start_time), end_time=int(end_time))
+        self.db.record_dump_stats(self.runid, dsched.disk, int(start_time), int(end_time),
+                                  dumper_cpu=dumper_cpu, pipe_cpu=loop.cpu_time,
+                                  comp_time=(0.0 if compressor is None
+                                             else compressor.comp_time))
+        info("%s: dump finished: %s (%s/%s, %d files, %.1fs)" %
              (cdisk.name, state, human_size(raw_size),
-              human_size(comp_size), nfiles))
+              human_size(comp_size), nfiles, end_time - start_time))
+
+
+    # __stop_dump:
+    #
+    # Stop a dump which raised: kill its processes so that the pipes
+    # still running get EOF, wait for them and drop the compressor
+    # (with its threads and pending blocks) and the dump file. The
+    # processes are waited by the caller.
+    #
+    def __stop_dump (self, cdisk, procs, pipes, compressor, fdest) :
+        for p in procs :
+            trace("%s: killing process %d" % (cdisk.name, p.pid))
+            cmdkill(p)
+        for p in pipes :
+            if p.started :
+                try:
+                    p.join()
+                except Exception as exc:
+                    trace("%s: pipe %s: %s" % (cdisk.name, p.name, exc_name(exc)))
+        if compressor is not None :
+            compressor.abort()
+        elif fdest is not None :
+            fdest.close()
 
 
 # exec
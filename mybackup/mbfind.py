@@ -0,0 +1,163 @@
+#
+
+import sys, getopt, tarfile
+
+from mybackup.base import *
+from mybackup.log import *
+from mybackup import mbapp
+from mybackup.catalog import Catalog, CatalogError, catalog_fname
+from mybackup.compress import COMPRESSORS, SeekableReader, SeekIndexError, \
+     read_seekindex, seekindex_fname
+
+
+# USAGE:
+#
+USAGE = """\
+USAGE: mbfind [OPTIONS] CONFIG PATTERN
+
+Find the dumps which contain the files matching PATTERN (a shell
+pattern relative to the disk root, or a plain path to list a file or
+a whole directory).
+
+OPTIONS:
+
+  -d, --disk DISK  only search the dumps of DISK (may be given
+                   multiple times)
+  -l, --long       also print the dump file and offset of each file
+  -x, --extract DIR
+                   extract the files found into DIR (only the part of
+                   the dump around each file is decompressed when the
+                   dump has a seek index)
+  -q, --quiet      be less verbose
+  -v, --verbose    be more verbose
+  -h, --help       print this message and exit
+"""
+
+
+# MBFindApp:
+#
+class MBFindApp (mbapp.MBAppBase) :
+
+
+    LOG_DOMAIN = 'mbfind'
+
+
+    # app_run:
+    #
+    def app_run (self) :
+        # parse the command line
+        disks = []
+        self.long = False
+        self.extract_dir = ''
+        shortopts = 'd:lx:hqv'
+        longopts = ['disk=', 'long', 'extract=', 'help']
+        opts, args = getopt.gnu_getopt(sys.argv[1:], shortopts, longopts)
+        for o, a in opts :
+            if o in ('-h', '--help') :
+                sys.stdout.write(USAGE)
+                sys.exit(0)
+            elif o in ('-d', '--disk') :
+                disks.append(a)
+            elif o in ('-l', '--long') :
+                self.long = True
+            elif o in ('-x', '--extract') :
+                self.extract_dir = os.path.abspath(a)
+            elif o in ('-q', '--quiet') :
+                self.quiet()
+            elif o in ('-v', '--verbose') :
+                self.verbose()
+            else :
+                assert 0, (o, a)
+        # init the config
+        assert len(args) == 2, args
+        self.init_config(args[0])
+        pattern = args[1]
+        for d in disks :
+            if d not in self.config.disks :
+                error("unknown disk: '%s'" % d)
+                sys.exit(1)
+        self.__find(pattern, disks)
+
+
+    # __find:
+    #
+    def __find (self, pattern, disks) :
+        db = self.open_db()
+        nfound = 0
+        for dump in db.select_dumps() :
+            if disks and dump['disk'] not in disks :
+                continue
+            dumpfile = os.path.join(self.config.dumpdir, dump['fname'])
+            catfile = catalog_fname(dumpfile)
+            try:
+                cat = Catalog(catfile)
+            except FileNotFoundError:
+                trace("%s: no catalog for dump '%s'" % (dump['disk'], dumpfile))
+                continue
+            except CatalogError as exc:
+                warning("%s" % exc)
+                continue
+            with cat :
+                for entry in cat.search(pattern) :
+                    nfound += 1
+                    self.__print(dump, dumpfile, entry)
+                    if self.extract_dir :
+                        self.__extract(dump, dumpfile, entry)
+        trace("%d file(s) found" % nfound)
+
+
+    # __print:
+    #
+    def __print (self, dump, dumpfile, entry) :
+        line = '%s %-10s %s %8s  %s' % (hrs2date(dump['hrs']), dump['disk'],
+                                        DumpState.tostr(dump['state'], up=True),
+                                        human_size(entry.size), entry.path)
+        if self.long :
+            line += '  (%s:%d)' % (dumpfile, entry.offset)
+        sys.stdout.write(line + '\n')
+
+
+    # __get_seekindex:
+    #
+    # Return (method, points) for 'dumpfile'. Without a seek index
+    # the only access point is the start of the dump.
+    #
+    def __get_seekindex (self, dumpfile) :
+        try:
+            return read_seekindex(seekindex_fname(dumpfile))
+        except FileNotFoundError:
+            trace("no seek index for '%s'" % dumpfile)
+        except SeekIndexError as exc:
+            warning("%s" % exc)
+        ext = os.path.splitext(dumpfile)[1]
+        for method, (mext, dflt, mx) in COMPRESSORS.items() :
+            if ext == mext :
+                return method, [(0, 0)]
+        assert 0, dumpfile
+
+
+    # __extract:
+    #
+    def __extract (self, dump, dumpfile, entry) :
+        target = os.path.join(self.extract_dir, dump['disk'], entry.path)
+        if entry.type in ('5', 'D') :
+            # GNU incremental dumps store directories as 'D' members,
+            # which tarfile would extract as regular files
+            if not os.path.isdir(target) :
+                os.makedirs(target)
+            return
+        method, points = self.__get_seekindex(dumpfile)
+        trace("extracting '%s' from %s:%d" % (entry.path, dumpfile, entry.offset))
+        with SeekableReader(dumpfile, method, points, entry.offset) as reader :
+            with tarfile.open(fileobj=reader, mode='r|') as tf :
+                member = tf.next()
+                if member is None :
+                    error("%s: no member at offset %d" % (dumpfile, entry.offset))
+                    return
+                tf.extract(member, os.path.join(self.extract_dir, dump['disk']),
+                           filter='data')
+
+
+# exec
+if __name__ == '__main__' :
+    MBFindApp.main()
@@ -0,0 +1,174 @@
+#
+
+import sys, getopt, glob
+from concurrent.futures import ProcessPoolExecutor
+
+from mybackup.base import *
+from mybackup.log import *
+from mybackup import mbapp
+from mybackup import mbdb
+from mybackup.journal import Journal, JOURNAL_FORMATS, \
+     read_journal_file, write_journal_file
+
+
+# USAGE:
+#
+USAGE = """\
+USAGE: mbjournal [OPTIONS] dump FILE
+       mbjournal [OPTIONS] convert SOURCE DEST
+       mbjournal [OPTIONS] archive CONFIG
+       mbjournal [OPTIONS] query CONFIG
+
+Print a journal file (text or binary) in text form, or convert it to
+the other format.
+
+'archive' imports the rolled journals of CONFIG which are not in its
+DB yet (new journals are imported when they are rolled), 'query'
+prints the archived records.
+
+OPTIONS:
+
+  -t, --to FORMAT  convert to FORMAT (text or binary, default: the
+                   other format)
+  -j, --jobs N     number of journals read in parallel by 'archive'
+                   (default: the number of CPUs)
+  -d, --disk DISK  only query the records of DISK (may be given
+                   multiple times)
+  -k, --key KEY    only query the records of type KEY, like ERROR or
+                   STRANGE (may be given multiple times)
+  -D, --days N     only query the runs of the last N days
+  -m, --match TEXT only query the records containing TEXT
+  -q, --quiet      be less verbose
+  -v, --verbose    be more verbose
+  -h, --help       print this message and exit
+"""
+
+
+# MBJournalApp:
+#
+class MBJournalApp (mbapp.MBAppBase) :
+
+
+    LOG_DOMAIN = 'mbjournal'
+
+
+    # app_run:
+    #
+    def app_run (self) :
+        # parse the command line
+        tofmt = ''
+        self.jobs = os.cpu_count() or 1
+        self.disks = []
+        self.keys = []
+        self.since = None
+        self.match = None
+        shortopts = 't:j:d:k:D:m:hqv'
+        longopts = ['to=', 'jobs=', 'disk=', 'key=', 'days=', 'match=', 'help']
+        opts, args = getopt.gnu_getopt(sys.argv[1:], shortopts, longopts)
+        for o, a in opts :
+            if o in ('-h', '--help') :
+                sys.stdout.write(USAGE)
+                sys.exit(0)
+            elif o in ('-t', '--to') :
+                if a not in JOURNAL_FORMATS :
+                    error("unknown journal format: '%s'" % a)
+                    sys.exit(1)
+                tofmt = a
+            elif o in ('-j', '--jobs') :
+                self.jobs = max(1, int(a))
+            elif o in ('-d', '--disk') :
+                self.disks.append(a)
+            elif o in ('-k', '--key') :
+                if a not in Journal.KEYSPECS :
+                    error("unknown journal key: '%s'" % a)
+                    sys.exit(1)
+                self.keys.append(a)
+            elif o in ('-D', '--days') :
+                self.since = stamp2hrs(int(time.time()) - int(a) * 86400)
+            elif o in ('-m', '--match') :
+                self.match = a
+            elif o in ('-q', '--quiet') :
+                self.quiet()
+            elif o in ('-v', '--verbose') :
+                self.verbose()
+            else :
+                assert 0, (o, a)
+        assert args, args
+        cmd = args.pop(0)
+        if cmd == 'dump' :
+            assert len(args) == 1, args
+            self.__dump(args[0])
+        elif cmd == 'convert' :
+            assert len(args) == 2, args
+            self.__convert(args[0], args[1], tofmt)
+        elif cmd == 'archive' :
+            assert len(args) == 1, args
+            self.init_config(args[0])
+            self.__archive()
+        elif cmd == 'query' :
+            assert len(args) == 1, args
+            self.init_config(args[0])
+            self.__query()
+        else :
+            error("unknown command: '%s'" % cmd)
+            sys.exit(1)
+
+
+    # __dump:
+    #
+    def __dump (self, fname) :
+        fmt, entries = read_journal_file(fname)
+        trace("%s: %s journal, %d records" % (fname, fmt, len(entries)))
+        for entry in entries :
+            sys.stdout.write(Journal.CODECS[entry.key].format_line(entry) + '\n')
+
+
+    # __convert:
+    #
+    def __convert (self, source, dest, tofmt) :
+        fmt, entries = read_journal_file(source)
+        if not tofmt :
+            tofmt = 'binary' if fmt == 'text' else 'text'
+        info("%s: converting %d records from %s to %s ('%s')" %
+             (source, len(entries), fmt, tofmt, dest))
+        write_journal_file(dest, entries, tofmt)
+
+
+    # __archive:
+    #
+    # The journals are parsed by a pool of processes, the DB is only
+    # written by this one (one transaction per journal).
+    #
+    def __archive (self) :
+        db = self.open_db(writer=True)
+        done = db.select_archived_journals()
+        fnames = [f for f in sorted(glob.glob(os.path.join(self.config.journaldir,
+                                                           'journal.*.*')))
+                  if mbdb.RE_ROLLED_JOURNAL.search(f)
+                  and os.path.basename(f) not in done]
+        if not fnames :
+            info("all the journals are already archived")
+            return
+        info("archiving %d journal(s) with %d job(s)" % (len(fnames), self.jobs))
+        nrecords = 0
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool :
+            for fname, r in zip(fnames, pool.map(mbdb.journal_archive_rows, fnames)) :
+                db.archive_journal(os.path.basename(fname), *r)
+                nrecords += len(r[3])
+        info("%d journal(s) archived, %d records" % (len(fnames), nrecords))
+
+
+    # __query:
+    #
+    def __query (self) :
+        db = self.open_db()
+        for r in db.select_journal_records(disks=self.disks, keys=self.keys,
+                                           since=self.since, match=self.match) :
+            sys.stdout.write('%s %4s %-10s %-14s %s\n' %
+                             (hrs2date(r['hrs']), r['runid'] or '-', r['disk'] or '-',
+                              r['key'], r['data']))
+
+
+# exec
+if __name__ == '__main__' :
+    MBJournalApp.main()
@@ -0,0 +1,134 @@
+#
+
+import sys, getopt
+
+from mybackup.base import *
+from mybackup.log import *
+from mybackup import mbapp
+
+
+# USAGE:
+#
+USAGE = """\
+USAGE: mbstats [OPTIONS] CONFIG [DISK...]
+
+Print the performance of the successful dumps of each disk (or of
+the given disks): duration, throughput (raw MB/s) and compression
+ratio, each one followed by its rolling average over the last dumps
+of the disk.
+
+OPTIONS:
+
+  -w, --window N   average over the last N dumps (default: 5)
+  -n, --last N     only print the last N dumps of each disk
+                   (default: 10, 0 for all of them)
+  -c, --cpu        also print the CPU time of the dumper and of the
+                   pipes, and the time spent compressing
+  -q, --quiet      be less verbose
+  -v, --verbose    be more verbose
+  -h, --help       print this message and exit
+"""
+
+
+# MBStatsApp:
+#
+class MBStatsApp (mbapp.MBAppBase) :
+
+
+    LOG_DOMAIN = 'mbstats'
+
+
+    # app_run:
+    #
+    def app_run (self) :
+        # parse the command line
+        window = 5
+        last = 10
+        self.cpu = False
+        shortopts = 'w:n:chqv'
+        longopts = ['window=', 'last=', 'cpu', 'help']
+        opts, args = getopt.gnu_getopt(sys.argv[1:], shortopts, longopts)
+        for o, a in opts :
+            if o in ('-h', '--help') :
+                sys.stdout.write(USAGE)
+                sys.exit(0)
+            elif o in ('-w', '--window') :
+                window = int(a)
+                if window < 1 :
+                    error("invalid window: %d" % window)
+                    sys.exit(1)
+            elif o in ('-n', '--last') :
+                last = max(0, int(a))
+            elif o in ('-c', '--cpu') :
+                self.cpu = True
+            elif o in ('-q', '--quiet') :
+                self.quiet()
+            elif o in ('-v', '--verbose') :
+                self.verbose()
+            else :
+                assert 0, (o, a)
+        # init the config
+        assert len(args) >= 1, args
+        self.init_config(args[0])
+        disks = args[1:]
+        for d in disks :
+            if d not in self.config.disks :
+                error("unknown disk: '%s'" % d)
+                sys.exit(1)
+        self.__print_trends(disks, window, last)
+
+
+    # __print_trends:
+    #
+    def __print_trends (self, disks, window, last) :
+        db = self.open_db()
+        rows = db.select_dump_trends(disks=disks, window=window, last=last)
+        if not rows :
+            info("no dump stats found")
+            return
+        head = '%-19s %-10s %17s %17s %13s' % ('DATE', 'DISK', 'DURATION (avg)',
+                                               'MB/S (avg)', 'RATIO (avg)')
+        if self.cpu :
+            head += ' %9s %9s %9s' % ('DUMPER', 'PIPES', 'COMPRESS')
+        sys.stdout.write(head + '\n')
+        for r in rows :
+            line = '%-19s %-10s %8s %8s %8s %8s %6s %6s' % \
+              (hrs2date(r.hrs), r.disk,
+               self.__duration(r.duration), '(%s)' % self.__duration(r.avg_duration),
+               self.__rate(r.rate), '(%s)' % self.__rate(r.avg_rate),
+               self.__ratio(r.ratio), '(%s)' % self.__ratio(r.avg_ratio))
+            if self.cpu :
+                line += ' %9s %9s %9s' % (self.__duration(r.dumper_cpu),
+                                          self.__duration(r.pipe_cpu),
+                                          self.__duration(r.comp_time))
+            sys.stdout.write(line + '\n')
+
+
+    # __duration:
+    #
+    def __duration (self, secs) :
+        if secs is None :
+            return '-'
+        if secs < 60 :
+            return '%.1fs' % secs
+        secs = int(secs + 0.5)
+        if secs < 3600 :
+            return '%d:%02d' % (secs // 60, secs % 60)
+        return '%d:%02d:%02d' % (secs // 3600, secs // 60 % 60, secs % 60)
+
+
+    # __rate:
+    #
+    def __rate (self, rate) :
+        return '-' if rate is None else '%.1f' % (rate / (1 << 20))
+
+
+    # __ratio:
+    #
+    def __ratio (self, ratio) :
+        return '-' if ratio is None else '%.2f' % ratio
+
+
+# exec
+if __name__ == '__main__' :
+    MBStatsApp.main()
@@ -1,6 +1,7 @@
 #
 
 import sys, os, getopt, traceback, subprocess, copy, codecs, fnmatch, weakref, sqlite3, time
+import urllib.parse
 from mybackup import mbuidlg
 
 # [todo]
@@ -354,10 +355,19 @@ class MBUIApp :
                       % {'config': self.config}))
 
 
+    # connect_db:
+    #
+    # mbui only reads the DB.
+    #
+    def connect_db (self) :
+        return sqlite3.connect('file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(self.dbfile)),
+                               uri=True)
+
+
     # d_select_disk_init:
     #
     def d_select_disk_init (self, dlg, e) :
-        db = sqlite3.connect(self.dbfile)
+        db = self.connect_db()
         c = db.cursor()
         c.execute('select disk from dumps group by disk')
         menu = [(str(n+1), d[0]) for n, d in enumerate(c.fetchall())]
@@ -368,7 +378,7 @@ class MBUIApp :
     # d_select_dump_init:
     #
     def d_select_dump_init (self, dlg, e) :
-        db = sqlite3.connect(self.dbfile)
+        db = self.connect_db()
         c = db.cursor()
         c.execute('select runid, fname from dumps where disk == ? order by runid desc', (self.disk,))
         dumps = list(c.fetchall())
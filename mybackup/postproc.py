@@ -11,6 +11,8 @@ from mybackup.log import *
 from mybackup.tools import *
 from mybackup import journal
 from mybackup import mbdb
+from mybackup.catalog import catalog_fname
+from mybackup.compress import seekindex_fname
 
 
 # PostProcPanic:
@@ -26,30 +28,13 @@ class PostProcess :
 
     # analysis:
     #
+    # Only the dump session matters here.
+    #
     # [FIXME] should be elsewhere
     #
     def analysis (self, state) :
-        ssdump = None
-        ssclean = None
-        # filter
-        for ss in state :
-            op = ss[0]
-            assert op.key == '_OPEN', op
-            if op.tool == 'dump' :
-                assert ssdump is None
-                ssdump = ss
-            elif op.tool == 'clean' :
-                ssclean = ss
-            else :
-                assert 0, ss
-
-        trace("analysing dump:\n%s" % '\n'.join(repr(s) for s in ssdump))
-        if ssclean is None :
-            trace("no last clean found")
-        else :
-            trace("found last clean state:\n%s" % '\n'.join(repr(s) for s in ssclean))
-
-        return JState.analysis([ssdump])
+        return JState.analysis(state, samples=self.config.report_samples,
+                               tools=('dump',))
 
 
     @staticmethod
@@ -100,7 +85,7 @@ class PostProcess :
     def run (self, config) :
         self.panic_count = 0
         self.config = config
-        self.db = mbdb.DB(self.config.dbfile)
+        self.db = mbdb.open_db(self.config.dbfile)
         self.journal = journal.Journal(config.journalfile, 'a',
                                        tool_name='clean',
                                        lockfile=config.journallock)
@@ -200,7 +185,7 @@ class PostProcess :
             if not DumpState.cmp(dump.state, 'partial', 'failed') :
                 self.error("%s: dump is '%s' but the dump does not exist! (%s)" %
                            (disk, DumpState.tostr(dump.state), partfile))
-            self.__fix_dump(disk, state=DumpState.EMPTY, fname='')
+            self.__fix_dump(disk, state=DumpState.EMPTY)
             return
         # check the size
         assert stat.S_ISREG(st.st_mode) # parano
@@ -209,10 +194,11 @@ class PostProcess :
             if not DumpState.cmp(dump.state, 'partial', 'failed') :
                 self.error("%s: dump is '%s' but the dump is empty! (%s)" %
                            (disk, DumpState.tostr(dump.state), partfile))
-            self.__fix_dump(disk, state=DumpState.EMPTY, fname='')
+            self.__fix_dump(disk, state=DumpState.EMPTY)
             # note: if cleanup is interrupted after this we'll get
             # a 'file does not exist' error instead of 'file is
             # empty'
+            self.__remove_sidecars(partfile)
             os.unlink(partfile)
             return
 
@@ -254,6 +240,40 @@ class PostProcess :
         # what else now ?
 
 
+    # SIDECARS:
+    #
+    # The files written next to a dump (catalog, seek index).
+    #
+    SIDECARS = (catalog_fname, seekindex_fname)
+
+
+    # __remove_sidecars:
+    #
+    def __remove_sidecars (self, partfile) :
+        for fname in self.SIDECARS :
+            partside = fname(partfile)
+            for f in (partside, partside + '.tmp') :
+                if os.path.exists(f) :
+                    trace("removing sidecar file '%s'" % f)
+                    os.unlink(f)
+
+
+    # __move_sidecars:
+    #
+    # Move the sidecar files along with their dump. They are not
+    # written if the dump was interrupted, so they may not exist.
+    #
+    def __move_sidecars (self, disk, partfile, destfile) :
+        for fname in self.SIDECARS :
+            partside = fname(partfile)
+            destside = fname(destfile)
+            if os.path.exists(partside + '.tmp') :
+                os.unlink(partside + '.tmp')
+            if os.path.exists(partside) :
+                trace("%s: moving sidecar '%s' -> '%s'" % (disk, partside, destside))
+                os.rename(partside, destside)
+
+
     # __process_move:
     #
     # Move the dump from 'partdir' to its final destination. At this
@@ -268,6 +288,8 @@ class PostProcess :
         destdir = os.path.dirname(destfile)
         if not os.path.isdir(destdir) :
             mkdir(destdir)
+        # the sidecars go first, so they are never left behind
+        self.__move_sidecars(disk, partfile, destfile)
         # check if we have a partfile
         if not os.path.exists(partfile) :
             if not os.path.exists(destfile) :
@@ -4,8 +4,6 @@ __all__ = [
     'Report',
 ]
 
-import copy
-
 from mybackup.sysconf import SYSCONF
 from mybackup.base import *
 from mybackup.log import *
@@ -19,10 +17,11 @@ class Report :
 
 
     ndumps = property(lambda s: len(s.runinfo.dumps))
-    nerrors = property(lambda s: len(s.errors))
-    nwarnings = property(lambda s: len(s.warnings))
-    nstranges = property(lambda s: len(s.stranges))
-    nnotes =  property(lambda s: len(s.notes))
+    nerrors = property(lambda s: s.errors.total)
+    nwarnings = property(lambda s: s.warnings.total)
+    nstranges = property(lambda s: s.stranges.total +
+                         s.strange_summaries.weight)
+    nnotes =  property(lambda s: s.notes.total)
     
     
     # __init__:
@@ -32,11 +31,8 @@ class Report :
         self.config = config
         self.running = False
         self.width = 70 #width
-        # open and read the journal
-        self.journal = journal.Journal(self.config.journalfile,
-                                       mode='r', tool_name='report',
-                                       lockfile=self.config.journallock)
-        self.runinfo = self.analysis(self.journal.get_state())
+        # read the journal
+        self.runinfo = self.analysis()
         self.__report_prep()
         self.__report_title()
         self.__report_body()
@@ -51,33 +47,26 @@ class Report :
 
     # analysis:
     #
-    def analysis (self, state) :
-        # filter
-        ssdump = None
-        ssclean = None
-        for session in state :
-            op = session[0]
-            assert op.key == '_OPEN', op
-            if op.tool == 'dump' :
-                assert ssdump is None
-                ssdump = session
-            elif op.tool == 'clean' :
-                ssclean = session
-            else :
-                assert 0, op.tool
-
-        return JState.analysis([ssdump, ssclean])
+    # The journal is folded as it is read, only a sample of the
+    # messages is kept.
+    #
+    def analysis (self) :
+        folder = JRunFolder(samples=self.config.report_samples)
+        return journal.fold_journal(self.config.journalfile,
+                                    self.config.journallock, folder)
 
 
     # __report_prep:
     #
     def __report_prep (self) :
         self.pre_errors = []
-        self.errors = copy.deepcopy(self.runinfo.errors)
-        self.warnings = copy.deepcopy(self.runinfo.warnings)
-        self.stranges = copy.deepcopy(self.runinfo.stranges)
-        self.notes = copy.deepcopy(self.runinfo.notes)
-        self.messages = copy.deepcopy(self.runinfo.messages)
+        # the runinfo is ours, no need to copy
+        self.errors = self.runinfo.errors
+        self.warnings = self.runinfo.warnings
+        self.stranges = self.runinfo.stranges
+        self.strange_summaries = self.runinfo.strange_summaries
+        self.notes = self.runinfo.notes
+        self.messages = self.runinfo.messages
         # [fixme]
         for nlvl, nmsg in self.messages :
             self.pre_errors.append("NOTE: %s" % nmsg)
@@ -107,7 +96,7 @@ class Report :
         self.errmark = ''
         self.errmark += ('!' if (self.errors or self.pre_errors) else '-')
         self.errmark += ('!' if self.warnings else '-')
-        self.errmark += ('!' if self.stranges else '-')
+        self.errmark += ('!' if self.nstranges else '-')
 
 
     # __report_title:
@@ -147,7 +136,7 @@ class Report :
         errs = []
         if self.errors : errs.append('%s' % plural(self.nerrors, 'error'))
         if self.warnings : errs.append('%s' % plural(self.nwarnings, 'warning'))
-        if self.stranges : errs.append('%s' % plural(self.nstranges, 'strange line'))
+        if self.nstranges : errs.append('%s' % plural(self.nstranges, 'strange line'))
         if errs :
             lines.append(" - WARNING: %s reported in this dump"
                           % ', '.join(errs))
@@ -164,19 +153,35 @@ class Report :
             lines.append(" - %s :" % plural(self.nerrors, 'error'))
             lines.append("")
             lines.extend(("   %s" % m) for m in self.errors)
+            lines.extend(self.__skipped(self.errors))
         if self.nwarnings :
             lines.append("")
             lines.append(" - %s :" % plural(self.nwarnings, 'warning'))
             lines.append("")
             lines.extend(("   %s" % m) for m in self.warnings)
+            lines.extend(self.__skipped(self.warnings))
         if self.nstranges :
             lines.append("")
             lines.append(" - %s :" % plural(self.nstranges, 'strange line'))
             lines.append("")
             lines.extend(("   %s: %s" % (s, m)) for s, m in self.stranges)
+            lines.extend(self.__skipped(self.stranges))
+            lines.extend(("   %s: ... and %s (%s), last: %s" %
+                          (s, plural(n, 'more line', 'more lines'), r, l))
+                         for s, r, n, l in self.strange_summaries)
         return '\n'.join(lines)
 
 
+    # __skipped:
+    #
+    # The line telling how many messages of a list were not kept.
+    #
+    def __skipped (self, samples) :
+        if samples.skipped :
+            return ["   ... and %s" % plural(samples.skipped, 'more', 'more')]
+        return []
+
+
     # __report_dumps:
     #
     def __report_dumps (self) :
@@ -0,0 +1,248 @@
+# tarindex.py - streaming tar archive indexer
+
+__all__ = [
+    'TarEntry',
+    'TarIndexer',
+]
+
+import collections
+
+from mybackup.base import *
+
+
+# TarEntry:
+#
+# One member of a tar stream. 'offset' is the position in the
+# (uncompressed) stream of the first header block of the member,
+# including its GNU longname or pax extended headers, so a reader
+# can start there to extract it.
+#
+TarEntry = collections.namedtuple(
+    'TarEntry',
+    ('path', 'size', 'mtime', 'mode', 'type', 'offset'))
+
+
+BLOCKSIZE = 512
+
+# member types which have no data blocks (whatever their size field
+# says)
+_NODATA_TYPES = frozenset(b'123456')
+
+# extended header types
+_GNU_LONGNAME = ord('L')
+_GNU_LONGLINK = ord('K')
+_PAX_HEADER = ord('x')
+_PAX_GLOBAL = ord('g')
+
+
+# TarIndexer:
+#
+# A file-like object which parses a tar stream written to it (ustar,
+# GNU and pax formats) and reports every member as a TarEntry. File
+# contents are skipped without being copied. Entries are passed to
+# 'handler' if given, else they are kept in 'entries'.
+#
+# Parsing errors don't raise (the stream must still go to the other
+# outputs of the pipe), they stop the indexer and are reported in
+# 'error'.
+#
+class TarIndexer :
+
+
+    # __init__:
+    #
+    def __init__ (self, handler=None) :
+        self.entries = []
+        self.handler = self.entries.append if handler is None else handler
+        self.count = 0
+        self.error = ''
+        self.pos = 0          # stream offset
+        self.header = bytearray()
+        self.skip = 0         # bytes to skip (data + padding)
+        self.extdata = None   # extended header data being collected
+        self.extsize = 0
+        self.exttype = 0
+        self.member_start = -1
+        self.longname = None
+        self.pax = {}
+        self.pax_global = {}
+        self.nzero = 0
+        self.finished = False
+
+
+    # write:
+    #
+    def write (self, data) :
+        if self.finished or self.error :
+            self.pos += len(data)
+            return
+        data = memoryview(data)
+        size = len(data)
+        p = 0
+        while p < size and not (self.finished or self.error) :
+            if self.skip :
+                n = min(self.skip, size - p)
+                if self.extdata is not None and len(self.extdata) < self.extsize :
+                    m = min(n, self.extsize - len(self.extdata))
+                    self.extdata.extend(data[p:p+m])
+                self.skip -= n
+                p += n
+                if self.skip == 0 and self.extdata is not None :
+                    self.__process_ext()
+            else :
+                n = min(BLOCKSIZE - len(self.header), size - p)
+                self.header.extend(data[p:p+n])
+                p += n
+                if len(self.header) == BLOCKSIZE :
+                    hpos = self.pos + p - BLOCKSIZE
+                    try:
+                        self.__process_header(bytes(self.header), hpos)
+                    except ValueError as exc:
+                        self.error = 'offset %d: %s' % (hpos, exc)
+                    self.header = bytearray()
+        self.pos += size
+
+
+    # close:
+    #
+    def close (self) :
+        if not (self.finished or self.error) :
+            if self.header or self.skip :
+                self.error = 'offset %d: truncated archive' % self.pos
+
+
+    # __process_header:
+    #
+    def __process_header (self, block, hpos) :
+        if block.count(0) == BLOCKSIZE :
+            self.nzero += 1
+            if self.nzero == 2 :
+                self.finished = True
+            return
+        if self.nzero :
+            raise ValueError("unexpected zero block")
+        _check_chksum(block)
+        if self.member_start < 0 :
+            self.member_start = hpos
+        tp = block[156]
+        size = _parse_number(block[124:136])
+        skip = (size + BLOCKSIZE - 1) // BLOCKSIZE * BLOCKSIZE
+        if tp in (_GNU_LONGNAME, _GNU_LONGLINK, _PAX_HEADER, _PAX_GLOBAL) :
+            self.extdata = bytearray()
+            self.extsize = size
+            self.exttype = tp
+            self.skip = skip
+            if skip == 0 :
+                self.__process_ext()
+            return
+        # a real member
+        pax = dict(self.pax_global)
+        pax.update(self.pax)
+        if 'path' in pax :
+            path = pax['path']
+        elif self.longname is not None :
+            path = self.longname
+        else :
+            path = _parse_str(block[0:100])
+            if block[257:263] == b'ustar\0' :
+                prefix = _parse_str(block[345:500])
+                if prefix :
+                    path = prefix + '/' + path
+        if 'size' in pax :
+            size = int(pax['size'])
+            skip = (size + BLOCKSIZE - 1) // BLOCKSIZE * BLOCKSIZE
+        if 'mtime' in pax :
+            mtime = int(float(pax['mtime']))
+        else :
+            mtime = _parse_number(block[136:148])
+        mode = _parse_number(block[100:108])
+        entry = TarEntry(path=path, size=size, mtime=mtime, mode=mode,
+                         type=(chr(tp) if tp else '0'),
+                         offset=self.member_start)
+        self.count += 1
+        self.handler(entry)
+        # reset the member state
+        self.member_start = -1
+        self.longname = None
+        self.pax = {}
+        if tp not in _NODATA_TYPES :
+            self.skip = skip
+
+
+    # __process_ext:
+    #
+    def __process_ext (self) :
+        data = bytes(self.extdata)
+        self.extdata = None
+        if self.exttype == _GNU_LONGNAME :
+            self.longname = _parse_str(data)
+        elif self.exttype == _GNU_LONGLINK :
+            pass
+        elif self.exttype == _PAX_HEADER :
+            self.pax.update(_parse_pax(data))
+        elif self.exttype == _PAX_GLOBAL :
+            self.pax_global.update(_parse_pax(data))
+        else :
+            assert 0, self.exttype
+
+
+# _parse_str:
+#
+def _parse_str (data) :
+    n = data.find(b'\0')
+    if n >= 0 :
+        data = data[:n]
+    return data.decode('utf-8', 'surrogateescape')
+
+
+# _parse_number:
+#
+# Octal, or GNU base-256 if the high bit of the first byte is set.
+#
+def _parse_number (data) :
+    if data[0] & 0x80 :
+        n = data[0] & 0x3f
+        for c in data[1:] :
+            n = (n << 8) | c
+        if data[0] & 0x40 :
+            n -= 1 << (6 + 8 * (len(data) - 1))
+        return n
+    data = data.rstrip(b'\0 ').lstrip(b' ')
+    if not data :
+        return 0
+    try:
+        return int(data, 8)
+    except ValueError:
+        raise ValueError("invalid number field: %r" % data)
+
+
+# _check_chksum:
+#
+def _check_chksum (block) :
+    stored = _parse_number(block[148:156])
+    unsigned = sum(block[:148]) + 256 + sum(block[156:])
+    if stored != unsigned :
+        # some old tars used signed chars
+        signed = sum(c - 256 if c > 127 else c for c in block[:148] + block[156:]) + 256
+        if stored != signed :
+            raise ValueError("invalid header checksum")
+
+
+# _parse_pax:
+#
+def _parse_pax (data) :
+    recs = {}
+    pos = 0
+    while pos < len(data) :
+        sp = data.find(b' ', pos)
+        if sp < 0 :
+            break
+        length = int(data[pos:sp])
+        if length <= 0 :
+            raise ValueError("invalid pax record")
+        rec = data[sp+1:pos+length-1] # strip the trailing newline
+        key, sep, value = rec.partition(b'=')
+        recs[key.decode('utf-8', 'surrogateescape')] = \
+          value.decode('utf-8', 'surrogateescape')
+        pos += length
+    return recs
@@ -4,15 +4,18 @@
 __all__ = [
     'CMDPIPE',
     'cmdexec',
+    'cmdwait',
+    'cmdkill',
     'mkdir',
     'create_file_nc',
     'backup_file',
     'sendmail',
+    'StrangeBudget',
     'StrangeParser',
     'DumperTar',
 ]
 
-import os, subprocess, shutil, re, threading, itertools
+import os, subprocess, shutil, re, threading, itertools, time, collections, signal
 CMDPIPE = subprocess.PIPE
 
 from mybackup.sysconf import SYSCONF
@@ -39,6 +42,29 @@ def cmdexec (cmd, wait=False, check=True, lang='', depth=0, **kw) :
     return r
 
 
+# cmdwait:
+#
+# Wait for a process started by cmdexec(), return its exit code and
+# the CPU time (user + system) it used, which Popen.wait() does not
+# give.
+#
+def cmdwait (proc) :
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, rusage.ru_utime + rusage.ru_stime
+
+
+# cmdkill:
+#
+# Kill a process started by cmdexec() without reaping it (unlike
+# Popen.kill(), which polls it first), so that cmdwait() still gets
+# its status.
+#
+def cmdkill (proc) :
+    if proc.returncode is None :
+        os.kill(proc.pid, signal.SIGKILL)
+
+
 # mkdir:
 #
 def mkdir (d) :
@@ -105,20 +131,62 @@ def sendmail (addrs, subject, body, maxsize=50) :
     return r
 
 
+# StrangeBudget:
+#
+# The number of strange and note lines which can still be recorded
+# one by one in the journal during a run, shared by all its parsers.
+#
+class StrangeBudget :
+
+
+    # __init__:
+    #
+    def __init__ (self, limit) :
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
+
+
+    # take:
+    #
+    def take (self) :
+        with self.lock :
+            if self.used >= self.limit :
+                return False
+            self.used += 1
+            return True
+
+
 # StrangeParser:
 #
+# Strange and note lines are grouped by rule: only the first SAMPLES
+# lines of each rule (and within the run's budget) are recorded as
+# is, the others are just counted and reported in a STRANGE-SUMMARY
+# record with the last one when the parser is closed. Records are
+# written to the journal in batches, which are flushed before any
+# warning or error line is logged.
+#
 class StrangeParser :
 
 
+    SAMPLES = 10       # lines recorded as is for each rule
+    BATCH = 64         # max records per journal write
+    FLUSH_DELAY = 1.0  # max delay before the records are written
+
+
     # __init__:
     #
-    def __init__ (self, name, journal, rules) :
+    def __init__ (self, name, journal, rules, budget=None) :
         self.name = name
         self.journal = journal
         self.rules = tuple((rname, re.compile("(?P<ALL>"+reg+")"), rcmd, rmsg)
                            for rname, reg, rcmd, rmsg in rules)
+        self.budget = budget
+        # (cmd, rule) -> [count, recorded, last line]
+        self.groups = collections.OrderedDict()
+        self.pending = []
+        self.flush_stamp = time.time()
         # lock it so we can use the same instance for multiple pipes
-        # (not necessary for now, but maybe later)
         self.lock = threading.Lock()
 
 
@@ -143,19 +211,76 @@ class StrangeParser :
         rname, cmd, line = self.match(line)
         if cmd == 'discard' :
             trace("%s: line discarded: '%s'" % (self.name, line))
-        elif cmd == 'strange' :
-            self.journal.record('STRANGE', source=self.name, message=line)
-        elif cmd == 'note' :
-            info("NOTE: %s" % line)
-            self.journal.record('NOTE', message=line)
+        elif cmd in ('strange', 'note') :
+            self.__collect(rname, cmd, line)
         elif cmd == 'warning' :
+            # keep the journal in the order of the output
+            self.flush()
             warning(line)
         elif cmd == 'error' :
+            self.flush()
             error(line)
         else :
             assert 0, (rname, cmd, line)
 
 
+    # flush:
+    #
+    # Write the pending records now.
+    #
+    def flush (self) :
+        with self.lock :
+            self.__flush()
+
+
+    # close:
+    #
+    # Record the summaries and flush the pending records.
+    #
+    def close (self) :
+        with self.lock :
+            for (cmd, rname), (count, nrec, last) in self.groups.items() :
+                if count > nrec :
+                    self.pending.append(('STRANGE-SUMMARY',
+                                         {'source': self.name, 'rule': rname,
+                                          'kind': cmd, 'skipped': count - nrec,
+                                          'last': last}))
+            self.groups.clear()
+            self.__flush()
+
+
+    # __collect:
+    #
+    def __collect (self, rname, cmd, line) :
+        with self.lock :
+            group = self.groups.get((cmd, rname))
+            if group is None :
+                group = self.groups[(cmd, rname)] = [0, 0, '']
+            group[0] += 1
+            group[2] = line
+            if group[1] < self.SAMPLES and \
+              (self.budget is None or self.budget.take()) :
+                group[1] += 1
+                if cmd == 'strange' :
+                    self.pending.append(('STRANGE', {'source': self.name,
+                                                     'message': line}))
+                else :
+                    info("NOTE: %s" % line)
+                    self.pending.append(('NOTE', {'message': line}))
+            if len(self.pending) >= self.BATCH or \
+              (self.pending and time.time() - self.flush_stamp >= self.FLUSH_DELAY) :
+                self.__flush()
+
+
+    # __flush:
+    #
+    def __flush (self) :
+        if self.pending :
+            self.journal.record_many(self.pending)
+            self.pending = []
+        self.flush_stamp = time.time()
+
+
 # DumperTar:
 #
 class DumperTar :
@@ -172,12 +297,3 @@ class DumperTar :
                '--totals', '--directory', path, '.']
         proc = cmdexec(cmd, stdout=CMDPIPE, stderr=CMDPIPE)
         return proc
-
-
-    # start_index:
-    #
-    def start_index (self) :
-        cmd = [self.GNUTAR, '--list', '--verbose',
-               '--file', '-']
-        proc = cmdexec(cmd, stdin=CMDPIPE, stdout=CMDPIPE)
-        return proc